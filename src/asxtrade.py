@@ -1,20 +1,35 @@
 #!/usr/bin/python3.8
 import pymongo
+from pymongo import UpdateOne, ReplaceOne, DeleteOne, DeleteMany
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo import monitoring
+from bson.objectid import ObjectId
 import argparse
 import requests
-import dateutil
+import dateutil.parser
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from datetime import datetime, timedelta, timezone, date
 import json
 import csv
+import io
+import gzip
 import olefile
-import tempfile
 import time
+import threading
+import sys
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from random import randint
 import pandas as pd
+import numpy as np
 import os
 import re
+import socket
+import persist_dataframes
 
 retry_strategy = Retry(
     total=10,
@@ -24,14 +39,93 @@ retry_strategy = Retry(
 )
 retry_adapter = HTTPAdapter(max_retries=retry_strategy)
 
+class ColumnBuffer:
+    """
+    Accumulate dict rows into per-column lists, so that the dataframe is built once at the end rather than
+    copied on every row as DataFrame.append() does. Rows may introduce new keys: earlier rows are NaN for them.
+    The built dataframe is typed as DataFrame.append() would have typed it, so that the TSV/CSV files we save
+    remain byte-compatible: numeric columns are float64 unless the first row had an integer value for them
+    (in which case the column is object, so integers are not written with a trailing .0) and datetime columns
+    with a single UTC offset are datetime64 (so all values are written with the same precision).
+    """
+    def __init__(self):
+        self.columns = {}
+        self.first_row_keys = None
+        self.index = []
+
+    def append(self, d, name):
+        assert isinstance(d, dict)
+        n = len(self.index)
+        if self.first_row_keys is None:
+            self.first_row_keys = set(d.keys())
+        for key in d.keys():
+            if not key in self.columns:
+                self.columns[key] = [np.nan] * n
+        for key, values in self.columns.items():
+            values.append(d.get(key, np.nan))
+        self.index.append(name)
+
+    def __len__(self):
+        return len(self.index)
+
+    def to_dataframe(self):
+        df = pd.DataFrame(self.columns, index=self.index, columns=list(self.columns.keys()), dtype=object)
+        for key, values in self.columns.items():
+            if key in self.first_row_keys and isinstance(values[0], int):
+                continue
+            if all([isinstance(v, (int, float)) and not isinstance(v, bool) for v in values]):
+                df[key] = df[key].astype(float)
+                continue
+            datetimes = [v for v in values if not (isinstance(v, float) and np.isnan(v))]
+            if all([isinstance(v, datetime) for v in datetimes]) and len(set([v.utcoffset() for v in datetimes])) == 1:
+                df[key] = pd.to_datetime(df[key])
+        return df
+
+def save_changes(collection, records, key_fields, compare_fields, max_removed_fraction=0.1):
+    """
+    Compare records (dicts) against the current contents of collection, loaded once with a projection, and write only
+    the inserted, changed and removed records with one unordered bulk_write(). Most of the records in a daily download
+    are unchanged, so this is a few dozen writes rather than one per record. Removals are skipped (with a warning) if
+    more than max_removed_fraction of the collection would go, as that is more likely a truncated download than
+    a mass delisting. Returns a dict summarising the changes.
+    """
+    assert len(records) > 0
+    projection = { field: 1 for field in key_fields + compare_fields }
+    projection.update({ '_id': 0 })
+    existing = { tuple([r.get(k) for k in key_fields]): r for r in collection.find({}, projection) }
+    ops = []
+    seen = set()
+    n_inserted = n_changed = 0
+    for rec in records:
+        key = tuple([rec.get(k) for k in key_fields])
+        seen.add(key)
+        current = existing.get(key)
+        if current is not None and all([current.get(f) == rec.get(f) for f in compare_fields]):
+            continue
+        if current is None:
+            n_inserted += 1
+        else:
+            n_changed += 1
+        ops.append(UpdateOne(dict(zip(key_fields, key)), { '$set': rec }, upsert=True))
+    removed = [key for key in existing.keys() if not key in seen]
+    if len(removed) > max_removed_fraction * len(existing):
+        print("WARNING: not removing {} of {} records from {} -- download incomplete?".format(len(removed), len(existing), collection.name))
+        removed = []
+    ops.extend([DeleteOne(dict(zip(key_fields, key))) for key in removed])
+    if len(ops) > 0:
+        collection.bulk_write(ops, ordered=False)
+    summary = { 'inserted': n_inserted, 'changed': n_changed, 'removed': len(removed), 'unchanged': len(records) - n_inserted - n_changed }
+    print("Updated {}: {}".format(collection.name, summary))
+    return summary
+
 def update_companies(db, config, ensure_indexes=True):
-    resp = requests.get(config.get('asx_companies'))
+    resp = get_fetcher().get(config.get('asx_companies'))
     if ensure_indexes:
         db.companies.create_index([( 'asx_code', pymongo.ASCENDING ) ], unique=True)
 
     fname = "{}/companies.{}.csv".format(config.get('data_root'), datetime.now().strftime("%Y-%m-%d"))
-    df = None
-    n = 0
+    rows = ColumnBuffer()
+    all_records = []
     for line in resp.text.splitlines():
         if any([line.startswith("ASX listed companies"), len(line.strip()) < 1, line.startswith("Company name")]):
             continue
@@ -43,30 +137,23 @@ def update_companies(db, config, ensure_indexes=True):
               "last_updated": datetime.utcnow() }
         assert len(d.get('asx_code')) >= 3
         assert len(d.get('name')) > 0
-        if df is None:
-            df = pd.DataFrame(columns=d.keys())
-        row = pd.Series(d, name=d.get('asx_code'))
-        df = df.append(row)
-        db.companies.find_one_and_update({ 'asx_code': d['asx_code'] }, { '$set': d }, upsert=True)
-        n += 1
-    df.to_csv(fname, sep='\t')
-    print("Saved {} companies to {} for validation by great_expectations.".format(n, fname))
+        rows.append(d, d.get('asx_code'))
+        all_records.append(d)
+    save_changes(db.companies, all_records, ['asx_code'], ['name', 'sector'])
+    rows.to_dataframe().to_csv(fname, sep='\t')
+    print("Saved {} companies to {} for validation by great_expectations.".format(len(all_records), fname))
 
 def update_isin(db, config, ensure_indexes=True):
-    resp = requests.get(config.get('asx_isin'))
+    resp = get_fetcher().get(config.get('asx_isin'))
     if ensure_indexes:
          db.asx_isin.create_index([( 'asx_code', pymongo.ASCENDING), ('asx_isin_code', pymongo.ASCENDING) ], unique=True)
 
-    df = None
-    with tempfile.NamedTemporaryFile() as content:
-         content.write(resp.content)
-         content.seek(0)
-         df = pd.read_csv(content.name, sep='\t')
+    with io.BytesIO(resp.content) as content:
+         df = pd.read_csv(content, sep='\t')
          print(df.describe())
 
     fname = "{}/asx_isin/isin.{}.csv".format(config.get('data_root'), datetime.now().strftime('%Y-%m-%d'))
     all_records = []
-    n = 0
     for row in df[4:].itertuples():
         # NB: first four rows are rubbish so we skip them during save...
         row_index, asx_code, company_name, security_name, isin_code = row
@@ -77,85 +164,895 @@ def update_isin(db, config, ensure_indexes=True):
         d = { 'asx_code': asx_code, 'company_name': company_name, 'security_name': security_name,
               'asx_isin_code': isin_code, 'last_updated': datetime.utcnow() }
         all_records.append(d)
-        db.asx_isin.find_one_and_update({ 'asx_isin_code': isin_code, 'asx_code': asx_code }, { "$set": d }, upsert=True)
-        n += 1
+    save_changes(db.asx_isin, all_records, ['asx_code', 'asx_isin_code'], ['company_name', 'security_name'])
     out_df = pd.DataFrame.from_records(all_records)
     out_df.to_csv(fname, sep='\t')
-    print("Saved {} securities to {} for validation.".format(n, fname))
+    print("Saved {} securities to {} for validation.".format(len(all_records), fname))
+
+asx_timezones = {}  # cache of "+1000" style UTC offsets to tzinfo, as there are only two in practice (AEST/AEDT)
+
+def parse_asx_datetime(value):
+    """
+    Parse the fixed ISO-8601 format used for dates in ASX payloads eg. 2020-07-24T00:00:00+1000 (or just YYYY-mm-dd).
+    This is more than an order of magnitude faster than dateutil.parser.parse(), which is only used when the value is not
+    in one of these formats (see bench_dates.py)
+    """
+    try:
+        if len(value) == 24 and value[10] == 'T' and value[19] in '+-' and value[13] == ':' and value[16] == ':':
+            offset = value[19:]
+            tz = asx_timezones.get(offset)
+            if tz is None:
+                minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+                tz = timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+                asx_timezones[offset] = tz
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]), tzinfo=tz)
+        elif len(value) == 10 and value[4] == '-' and value[7] == '-':
+            return datetime.fromisoformat(value) # NB: as for fetch dates in the viewer (see app.dates.parse_fetch_date())
+    except ValueError:
+        pass # FALLTHRU to the slow path
+    return dateutil.parser.parse(value)
+
+class Histogram:
+    """
+    Prometheus-style histogram: count of observations <= each bucket upper bound, plus their sum and count
+    """
+    def __init__(self, buckets):
+        self.buckets = list(buckets) + [float('inf')]
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        return list(zip(self.buckets, np.cumsum(self.counts).tolist()))
+
+class Metrics:
+    """
+    Instrumentation for an ingest run: HTTP latency histograms, responses and urllib3 retries by status code and bytes
+    downloaded (per phase), Mongo command latency (per command and collection) and wall time for each phase. Phases run
+    one after another, so everything observed is attributed to the current phase (see phase()). Thread-safe.
+    Written out by write_prometheus() and summary() at the end of a run.
+    """
+    http_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    mongo_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current_phase = 'other'
+        self.phase_seconds = {}
+        self.http_latency = defaultdict(lambda: Histogram(self.http_buckets))   # phase -> Histogram
+        self.responses = defaultdict(int)                                       # (phase, status) -> count
+        self.retries = defaultdict(int)                                         # (phase, status) -> count
+        self.bytes_downloaded = defaultdict(int)                                # phase -> bytes
+        self.mongo_latency = defaultdict(lambda: Histogram(self.mongo_buckets)) # (command, collection) -> Histogram
+        self.mongo_failures = defaultdict(int)                                  # (command, collection) -> count
+
+    @contextmanager
+    def phase(self, name):
+        previous = self.current_phase
+        self.current_phase = name
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + time.monotonic() - start
+            self.current_phase = previous
+
+    def observe_response(self, resp, *args, **kwargs):
+        """
+        requests response hook (see get_fetcher()). NB: resp.elapsed includes any retries and backoff done by urllib3
+        """
+        phase = self.current_phase
+        retry = getattr(getattr(resp, 'raw', None), 'retries', None)
+        history = retry.history if retry is not None else ()
+        with self.lock:
+            self.http_latency[phase].observe(resp.elapsed.total_seconds())
+            self.responses[(phase, resp.status_code)] += 1
+            self.bytes_downloaded[phase] += len(resp.content)
+            for attempt in history:
+                self.retries[(phase, attempt.status if attempt.status is not None else 'error')] += 1
+
+    def observe_mongo(self, command, collection, seconds, failed=False):
+        with self.lock:
+            self.mongo_latency[(command, collection)].observe(seconds)
+            if failed:
+                self.mongo_failures[(command, collection)] += 1
+
+    def summary(self, phase=None):
+        """
+        Return a JSON-friendly summary of the metrics, for all phases or just the named phase
+        """
+        with self.lock:
+            phases = sorted(set(self.phase_seconds.keys()).union(self.http_latency.keys())) if phase is None else [phase]
+            ret = { 'phases': {} }
+            for p in phases:
+                h = self.http_latency.get(p)
+                ret['phases'][p] = { 'wall_seconds': self.phase_seconds.get(p),
+                                     'requests': h.count if h is not None else 0,
+                                     'request_seconds': h.sum if h is not None else 0.0,
+                                     'latency_buckets': [[le, n] for le, n in h.cumulative()[:-1]] if h is not None else [],
+                                     'responses': { str(status): n for (ph, status), n in self.responses.items() if ph == p },
+                                     'retries': { str(status): n for (ph, status), n in self.retries.items() if ph == p },
+                                     'bytes_downloaded': self.bytes_downloaded.get(p, 0) }
+            if phase is None:
+                # NB: the summary is saved to Mongo, so keys must not contain dots: nested rather than "collection.command"
+                # keys, and dots in collection names (eg. GridFS market_quote_cache.files) become underscores
+                ret['mongo'] = {}
+                for (command, collection), h in self.mongo_latency.items():
+                    ret['mongo'].setdefault(collection.replace('.', '_') if len(collection) > 0 else 'none', {})[command] = \
+                          { 'ops': h.count, 'seconds': h.sum, 'failures': self.mongo_failures.get((command, collection), 0) }
+            return ret
+
+    def write_prometheus(self, fname):
+        """
+        Save the metrics to fname in the Prometheus text exposition format, eg. for the node_exporter textfile collector
+        """
+        def histogram(lines, name, labels, h):
+            for le, n in h.cumulative():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, "+Inf" if le == float('inf') else le, n))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, h.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, h.count))
+
+        with self.lock:
+            lines = ['# HELP asxtrade_http_request_seconds HTTP response latency (incl. retries) by ingest phase',
+                     '# TYPE asxtrade_http_request_seconds histogram']
+            for phase, h in sorted(self.http_latency.items()):
+                histogram(lines, 'asxtrade_http_request_seconds', 'phase="{}"'.format(phase), h)
+            lines.extend(['# HELP asxtrade_http_responses_total HTTP responses by ingest phase and status',
+                          '# TYPE asxtrade_http_responses_total counter'])
+            lines.extend(['asxtrade_http_responses_total{{phase="{}",status="{}"}} {}'.format(phase, status, n)
+                          for (phase, status), n in sorted(self.responses.items(), key=str)])
+            lines.extend(['# HELP asxtrade_http_retries_total Requests retried by urllib3 by ingest phase and status',
+                          '# TYPE asxtrade_http_retries_total counter'])
+            lines.extend(['asxtrade_http_retries_total{{phase="{}",status="{}"}} {}'.format(phase, status, n)
+                          for (phase, status), n in sorted(self.retries.items(), key=str)])
+            lines.extend(['# HELP asxtrade_http_bytes_total Response bytes downloaded by ingest phase',
+                          '# TYPE asxtrade_http_bytes_total counter'])
+            lines.extend(['asxtrade_http_bytes_total{{phase="{}"}} {}'.format(phase, n) for phase, n in sorted(self.bytes_downloaded.items())])
+            lines.extend(['# HELP asxtrade_mongo_op_seconds Mongo command latency by command and collection',
+                          '# TYPE asxtrade_mongo_op_seconds histogram'])
+            for (command, collection), h in sorted(self.mongo_latency.items()):
+                histogram(lines, 'asxtrade_mongo_op_seconds', 'command="{}",collection="{}"'.format(command, collection), h)
+            lines.extend(['# HELP asxtrade_phase_seconds Wall time of each ingest phase',
+                          '# TYPE asxtrade_phase_seconds gauge'])
+            lines.extend(['asxtrade_phase_seconds{{phase="{}"}} {}'.format(phase, seconds) for phase, seconds in sorted(self.phase_seconds.items())])
+        tmp = fname + ".tmp"
+        with open(tmp, 'w') as fp:  # NB: rename so that a scrape never sees a partially written file
+            fp.write("\n".join(lines) + "\n")
+        os.replace(tmp, fname)
+        print("Saved metrics to {}".format(fname))
+
+metrics = Metrics()
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """
+    Record the latency of each Mongo command in metrics. Register with MongoClient(..., event_listeners=[...])
+    """
+    def __init__(self):
+        self.collections = {}  # request_id -> collection, as only the started event has the command document
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        with self.lock:
+            self.collections[event.request_id] = collection if isinstance(collection, str) else ''
+
+    def finished(self, event, failed):
+        with self.lock:
+            collection = self.collections.pop(event.request_id, '')
+        metrics.observe_mongo(event.command_name, collection, event.duration_micros / 1000000.0, failed=failed)
+
+    def succeeded(self, event):
+        self.finished(event, False)
+
+    def failed(self, event):
+        self.finished(event, True)
 
 def get_fetcher():
     fetcher = requests.Session()
     fetcher.mount("https://", retry_adapter)
     fetcher.mount("http://", retry_adapter)
+    fetcher.hooks['response'].append(metrics.observe_response)
     return fetcher
 
-def validate_prices(dataframe):
+price_fields = ['last_price', 'open_price', 'day_high_price', 'day_low_price', 'bid_price', 'offer_price',
+                'previous_close_price', 'year_high_price', 'year_low_price']
+
+def previous_prices(db, fetch_date):
+    """
+    Return the last_price series (indexed by asx_code) for the most recent day before fetch_date in the monthly
+    last_price matrix saved by persist_dataframes.py (trying the previous month if need be), or None if there is none
+    """
+    day = datetime.strptime(fetch_date, "%Y-%m-%d")
+    for month, year in [(day.month, day.year), ((day - timedelta(days=day.day)).month, (day - timedelta(days=day.day)).year)]:
+        rec = db.market_quote_cache.find_one({ 'tag': "last_price-{:02d}-{}-asx".format(month, year), 'scope': 'all-downloaded' })
+        if rec is None:
+            continue
+        df = persist_dataframes.read_matrix(db, rec)
+        dates = sorted([d for d in df.columns if d < fetch_date and df[d].notnull().any()])
+        if len(dates) > 0:
+            return df[dates[-1]].rename(dates[-1])
+    return None
+
+def validate_prices(dataframe, db=None, fetch_date=None, previous=None, max_jump=0.5):
+    """
+    Sanity check a day's prices (asx_code X fields, as saved to prices.<date>.tsv) and return a report of the
+    stocks failing each check. Vectorised so it takes milliseconds even for the whole market. Day-over-day moves of more
+    than max_jump (a fraction) compared to previous (a last_price series, by default from the monthly matrix when db is
+    given) are warnings rather than errors: they happen, but are worth a look. If db is given, the report is saved to
+    db.price_validation keyed by fetch_date.
+    """
+    assert dataframe is not None
+    start = time.monotonic()
+    if isinstance(dataframe, str):  # TSV filename?
+        dataframe = pd.read_csv(dataframe, sep='\t', index_col=0)
+    df = dataframe
+    checks = {}
+    def check(name, failed, severity='error'):
+        failed = failed.fillna(False) if isinstance(failed, pd.Series) else failed
+        codes = [str(code) for code in df.index[failed.values]] if isinstance(failed, pd.Series) else list(failed)
+        checks[name] = { 'severity': severity, 'n_failed': len(codes), 'examples': codes[:10] }
+
+    numeric_fields = [field for field in price_fields + ['change_price', 'volume', 'pe', 'eps', 'market_cap'] if field in df.columns]
+    # NB: int fields are object dtype in frames built by update_prices(), so check the values can be coerced rather than the dtype
+    numeric = df[numeric_fields].apply(pd.to_numeric, errors='coerce')
+    check('numeric_values', (numeric.isnull() & df[numeric_fields].notnull()).any(axis=1))
+    present = [field for field in price_fields if field in numeric.columns]
+    check('non_negative_prices', (numeric[present] < 0.0).any(axis=1))
+    if all([field in numeric.columns for field in ['day_low_price', 'last_price', 'day_high_price']]):
+        traded = (numeric['day_low_price'] > 0.0) & (numeric['day_high_price'] > 0.0) & (numeric['last_price'] > 0.0)
+        check('day_range', traded & ((numeric['day_low_price'] > numeric['last_price']) | (numeric['last_price'] > numeric['day_high_price'])))
+    if 'volume' in numeric.columns:
+        volume = numeric['volume']
+        check('volume', (volume < 0) | (volume.notnull() & (volume != np.floor(volume))))
+    check('duplicate_codes', pd.Series(df.index.duplicated(), index=df.index))
+    if previous is None and db is not None and fetch_date is not None:
+        previous = previous_prices(db, fetch_date)
+    if previous is not None and 'last_price' in numeric.columns:
+        prev = previous.reindex(df.index)
+        jump = (numeric['last_price'] / prev - 1.0).abs()
+        check('day_over_day_jump', (prev > 0.0) & (numeric['last_price'] > 0.0) & (jump > max_jump), severity='warning')
+
+    report = { 'fetch_date': fetch_date, 'n_stocks': len(df), 'checks': checks,
+               'passed': all([c.get('n_failed') == 0 for c in checks.values() if c.get('severity') == 'error']),
+               'previous_date': previous.name if previous is not None else None,
+               'elapsed_ms': (time.monotonic() - start) * 1000.0, 'validated_at': datetime.utcnow() }
+    for name, c in checks.items():
+        if c.get('n_failed') > 0:
+            print("{}: {} stocks failed check {}, eg. {}".format(c.get('severity').upper(), c.get('n_failed'), name, c.get('examples')))
+    print("Validated {} stocks in {:.1f}ms: {}".format(len(df), report.get('elapsed_ms'), "passed" if report.get('passed') else "FAILED"))
+    if db is not None and fetch_date is not None:
+        db.price_validation.update_one({ 'fetch_date': fetch_date }, { '$set': report }, upsert=True)
+    return report
+
+def export_expectations(dataframe, suite_name='asx_prices'):
+    """
+    Save the checks done by validate_prices() as a great_expectations suite (in the great_expectations/ project
+    in the current directory) for offline use with data docs. Requires great_expectations.
+    """
     assert dataframe is not None
     import great_expectations as ge
     if isinstance(dataframe, str):  # TSV filename?
-        dataframe = pd.read_csv(dataframe, sep='\t')
+        dataframe = pd.read_csv(dataframe, sep='\t', index_col=0)
+    dataset = ge.from_pandas(dataframe.reset_index().rename(columns={ 'index': 'asx_code' }))
+    dataset.expect_column_values_to_be_unique('asx_code')
+    for field in [field for field in price_fields if field in dataframe.columns]:
+        dataset.expect_column_values_to_be_between(field, min_value=0.0)
+    if 'volume' in dataframe.columns:
+        dataset.expect_column_values_to_be_between('volume', min_value=0)
     context = ge.data_context.DataContext()
-    print(context.get_available_data_asset_names())
-    #context.
+    context.save_expectation_suite(dataset.get_expectation_suite(discard_failed_expectations=False), suite_name)
+    print("Saved expectation suite {}".format(suite_name))
+
+class TokenBucket:
+    """
+    Thread-safe token bucket enforcing a global requests-per-second budget across all fetcher threads. Callers must
+    acquire() a token before each HTTP request: this replaces the fixed sleep after each request we used to do.
+    """
+    def __init__(self, rate, capacity=1):
+        assert rate > 0
+        assert capacity >= 1
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class BulkWriter:
+    """
+    Buffer write operations (eg. UpdateOne) for a collection and send them as unordered bulk_write() batches of
+    batch_size, so we pay one round trip per batch rather than one per document. Thread-safe: fetcher threads
+    may add() directly. Use as a context manager (or call flush()) to ensure the remainder is written. If on_write is
+    given, it is called as on_write(keys, error) once each batch has been written, with the keys passed to add() for
+    the ops which were saved (error is None) and again for those which were not (with the exception).
+    """
+    def __init__(self, collection, batch_size=100, on_write=None):
+        assert collection is not None
+        assert batch_size >= 1
+        self.collection = collection
+        self.batch_size = batch_size
+        self.on_write = on_write
+        self.pending = []
+        self.pending_keys = []
+        self.n_written = 0
+        self.lock = threading.Lock()
+
+    def add(self, op, key=None):
+        with self.lock:
+            self.pending.append(op)
+            self.pending_keys.append(key)
+            if len(self.pending) < self.batch_size:
+                return
+            ops, keys = self.pending, self.pending_keys
+            self.pending, self.pending_keys = [], []
+        self.write(ops, keys)
+
+    def flush(self):
+        with self.lock:
+            ops, keys = self.pending, self.pending_keys
+            self.pending, self.pending_keys = [], []
+        if len(ops) > 0:
+            self.write(ops, keys)
+
+    def write(self, ops, keys=None):
+        try:
+            self.collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # NB: unordered, so every op without a write error was saved
+            failed = set([err.get('index') for err in e.details.get('writeErrors', [])])
+            self.written(keys, [i for i in range(len(ops)) if not i in failed], None)
+            self.written(keys, sorted(failed), e)
+            raise
+        except Exception as e:
+            self.written(keys, range(len(ops)), e)
+            raise
+        self.written(keys, range(len(ops)), None)
+
+    def written(self, keys, indexes, error):
+        indexes = list(indexes)
+        if error is None:
+            with self.lock:
+                self.n_written += len(indexes)
+        if self.on_write is not None and keys is not None and len(indexes) > 0:
+            self.on_write([keys[i] for i in indexes], error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+class RunJournal:
+    """
+    Record the outcome for each stock of an ingest run (kind is 'prices' or 'details') in db.ingest_journal, keyed by
+    run_id and asx_code, with a summary of the run in db.ingest_runs. Should a multi-hour run die partway, --resume
+    fetches only the stocks which failed or were never tried. Thread-safe, since records go through a BulkWriter.
+    """
+    def __init__(self, db, kind, fetch_date, run_id=None, batch_size=100):
+        assert db is not None
+        assert kind in ('prices', 'details')
+        self.db = db
+        self.kind = kind
+        self.fetch_date = fetch_date
+        if run_id is None:
+            run_id = "{}-{}-{}".format(kind, fetch_date, datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+        self.run_id = run_id
+        self.writer = BulkWriter(db.ingest_journal, batch_size)
+
+    @classmethod
+    def resume(cls, db, kind, fetch_date, batch_size=100):
+        """
+        Return a journal for the most recent run of kind for fetch_date or None if there is no such run
+        """
+        runs = list(db.ingest_runs.find({ 'kind': kind, 'fetch_date': fetch_date }).sort([('started', pymongo.DESCENDING)]).limit(1))
+        if len(runs) == 0:
+            return None
+        return cls(db, kind, fetch_date, run_id=runs[0].get('run_id'), batch_size=batch_size)
+
+    def start(self, stocks):
+        """
+        Register the run and each stock as untried, unless already present from a previous attempt at this run
+        """
+        self.db.ingest_journal.create_index([('run_id', pymongo.ASCENDING), ('asx_code', pymongo.ASCENDING)], unique=True)
+        now = datetime.utcnow()
+        self.db.ingest_runs.update_one({ 'run_id': self.run_id },
+                                       { '$set': { 'run_id': self.run_id, 'kind': self.kind, 'fetch_date': self.fetch_date,
+                                                   'status': 'running', 'last_updated': now },
+                                         '$setOnInsert': { 'started': now }}, upsert=True)
+        for asx_code in stocks:
+            self.writer.add(UpdateOne({ 'run_id': self.run_id, 'asx_code': asx_code },
+                                      { '$setOnInsert': { 'run_id': self.run_id, 'asx_code': asx_code, 'kind': self.kind,
+                                                          'fetch_date': self.fetch_date, 'status': 'untried', 'attempts': 0 }},
+                                      upsert=True))
+        self.writer.flush()
+        print("Journalling run {} for {} stocks".format(self.run_id, len(stocks)))
+
+    def record(self, asx_code, status, latency=None, error=None):
+        assert status in ('ok', 'failed', 'skipped')
+        update = { '$set': { 'status': status, 'latency': latency, 'error': error, 'last_updated': datetime.utcnow() }}
+        if status != 'skipped':
+            update['$inc'] = { 'attempts': 1 }
+        self.writer.add(UpdateOne({ 'run_id': self.run_id, 'asx_code': asx_code }, update))
+
+    def record_writes(self, keys, error):
+        """
+        BulkWriter on_write callback: stocks are only journalled as ok once their document has been saved, so that a
+        crash never leaves a stock ok in the journal but missing from the database. keys are (asx_code, latency) pairs.
+        """
+        for asx_code, latency in keys:
+            if error is None:
+                self.record(asx_code, 'ok', latency=latency)
+            else:
+                self.record(asx_code, 'failed', latency=latency, error=str(error))
+
+    def flush(self):
+        self.writer.flush()
+
+    def claim_finish(self):
+        """
+        Return True if the caller is the one to finish the run: when several workers share a run, more than one may see
+        its last batch done, but only one must finish it (and save the TSV, refresh matrices etc.)
+        """
+        self.writer.flush()
+        rec = self.db.ingest_runs.find_one_and_update({ 'run_id': self.run_id, 'status': { '$nin': ['finishing', 'completed'] } },
+                                                      { '$set': { 'status': 'finishing', 'last_updated': datetime.utcnow() }})
+        return rec is not None
+
+    def finish(self):
+        self.writer.flush()
+        counts = { rec['_id']: rec['n'] for rec in self.db.ingest_journal.aggregate([
+                        { '$match': { 'run_id': self.run_id } },
+                        { '$group': { '_id': '$status', 'n': { '$sum': 1 } } } ]) }
+        self.db.ingest_runs.update_one({ 'run_id': self.run_id },
+                                       { '$set': { 'status': 'completed', 'counts': counts, 'finished': datetime.utcnow(),
+                                                   'last_updated': datetime.utcnow(),
+                                                   'metrics': metrics.summary(metrics.current_phase) }})
+        print("Run {} completed: {}".format(self.run_id, counts))
+
+    def pending_stocks(self):
+        """
+        Return the stocks which failed or were never tried, in priority order: untried stocks first, then failed
+        stocks with the fewest attempts (so that persistently failing stocks are tried last)
+        """
+        recs = self.db.ingest_journal.find({ 'run_id': self.run_id, 'status': { '$in': ['untried', 'failed'] } },
+                                           { 'asx_code': 1, 'status': 1, 'attempts': 1 })
+        ordered = sorted(recs, key=lambda r: (r.get('status') != 'untried', r.get('attempts', 0), r.get('asx_code')))
+        return [r.get('asx_code') for r in ordered]
+
+class ResponseArchive:
+    """
+    Append-only archive of the raw responses of an ingest run, saved to data_root/raw/<kind>.<fetch_date>.jsonl.gz so
+    that asx_prices and asx_company_details can be rebuilt (--replay) without refetching. Each line is a JSON object with
+    the asx_code, fetch_date, HTTP status, fetched_at and response body. Lines are written as a separate gzip member per
+    batch, so a crash loses at most one batch and never corrupts what is already written: gzip readers transparently
+    concatenate members. Thread-safe. Disabled if config['archive_raw_responses'] is false.
+    """
+    def __init__(self, config, kind, fetch_date, batch_size=100):
+        assert kind in ('prices', 'details')
+        self.enabled = bool(config.get('archive_raw_responses', True))
+        self.fetch_date = fetch_date
+        self.path = archive_path(config, kind, fetch_date)
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def add(self, asx_code, fetch_date, status, body):
+        if not self.enabled:
+            return
+        line = json.dumps({ 'asx_code': asx_code, 'fetch_date': fetch_date, 'status': status,
+                            'fetched_at': datetime.utcnow().isoformat(), 'body': body })
+        with self.lock:
+            self.pending.append(line)
+            if len(self.pending) >= self.batch_size:
+                self.write()
+
+    def write(self):
+        # NB: caller must hold self.lock
+        if len(self.pending) == 0:
+            return
+        with open(self.path, 'ab') as fp:
+            fp.write(gzip.compress(("\n".join(self.pending) + "\n").encode('utf-8')))
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def archive_path(config, kind, fetch_date):
+    return "{}/raw/{}.{}.jsonl.gz".format(config.get('data_root'), kind, fetch_date)
+
+def read_archive(path):
+    """
+    Yield each record in the archive at path, stopping (with a warning) at a truncated gzip member
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as fp:
+        try:
+            for line in fp:
+                yield json.loads(line)
+        except (EOFError, ValueError) as e:
+            print("WARNING: {} is truncated, ignoring the remainder: {}".format(path, str(e)))
+
+class MongoRateLimiter:
+    """
+    Requests-per-second budget shared by every worker process (on any host) via db.ingest_rate_limits. Each acquire()
+    atomically increments the counter for the current time window and waits for the next window once the budget for
+    this one is spent. Windows are derived from the local clock, so hosts should be NTP-synced. Same interface as TokenBucket.
+    """
+    def __init__(self, db, name, rate):
+        assert db is not None
+        assert rate > 0
+        self.db = db
+        self.name = name
+        self.window = max(1.0, 1.0 / rate)   # seconds: budgets below 1 request/sec get a longer window
+        self.limit = max(1, int(rate * self.window))
+        db.ingest_rate_limits.create_index('expires', expireAfterSeconds=0)
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            window = int(now // self.window)
+            try:
+                rec = self.db.ingest_rate_limits.find_one_and_update({ '_id': "{}-{}".format(self.name, window) },
+                                                                     { '$inc': { 'n': 1 },
+                                                                       '$setOnInsert': { 'expires': datetime.utcfromtimestamp((window + 2) * self.window) }},
+                                                                     upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:  # another worker created this window's counter first: try again
+                continue
+            if rec.get('n') <= self.limit:
+                return
+            time.sleep(max(0.0, (window + 1) * self.window - time.time()))
+
+class WorkQueue:
+    """
+    Batches of stocks to fetch for an ingest run (kind, fetch_date) held in db.ingest_queue, so that several --worker
+    processes (possibly on different hosts) can share a run. A worker claims a batch by taking a lease on it: should
+    the worker die, the lease expires after lease_seconds and the batch is reclaimed by the next worker to claim().
+    Long-running batches keep their lease via heartbeat().
+    """
+    def __init__(self, db, kind, fetch_date, worker_id=None, lease_seconds=600):
+        assert db is not None
+        assert kind in ('prices', 'details')
+        assert lease_seconds > 0
+        self.db = db
+        self.queue = "{}-{}".format(kind, fetch_date)
+        self.worker_id = worker_id if worker_id is not None else "{}-{}".format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.last_renewed = None
+
+    def populate(self, stocks, batch_size=50):
+        """
+        Create the batches for the run, unless another worker has already done so: every worker may call this
+        """
+        assert batch_size >= 1
+        self.db.ingest_queue.create_index([('queue', pymongo.ASCENDING), ('batch', pymongo.ASCENDING)], unique=True)
+        stocks = sorted(set(stocks))  # same batches regardless of which worker gets here first
+        ops = [UpdateOne({ 'queue': self.queue, 'batch': i // batch_size },
+                         { '$setOnInsert': { 'queue': self.queue, 'batch': i // batch_size, 'stocks': stocks[i:i+batch_size],
+                                             'status': 'pending', 'attempts': 0, 'created': datetime.utcnow() }},
+                         upsert=True) for i in range(0, len(stocks), batch_size)]
+        if len(ops) == 0:
+            return
+        try:
+            self.db.ingest_queue.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            if any([err.get('code') != 11000 for err in e.details.get('writeErrors', [])]):
+                raise
+
+    def claim(self):
+        """
+        Lease the next pending batch (or one whose lease has expired) and return it, or None if there is nothing left to do
+        """
+        now = datetime.utcnow()
+        batch = self.db.ingest_queue.find_one_and_update({ 'queue': self.queue,
+                                                           '$or': [{ 'status': 'pending' },
+                                                                   { 'status': 'leased', 'lease_expires': { '$lt': now } }] },
+                                                         { '$set': { 'status': 'leased', 'owner': self.worker_id,
+                                                                     'lease_expires': now + timedelta(seconds=self.lease_seconds) },
+                                                           '$inc': { 'attempts': 1 } },
+                                                         sort=[('batch', pymongo.ASCENDING)], return_document=ReturnDocument.BEFORE)
+        if batch is None:
+            return None
+        if batch.get('status') == 'leased':
+            print("Reclaiming batch {} of {} from {} (lease expired {})".format(batch.get('batch'), self.queue, batch.get('owner'), batch.get('lease_expires')))
+        self.last_renewed = time.monotonic()
+        return batch
+
+    def wait_time(self):
+        """
+        Return the seconds until the first outstanding lease held by another worker expires (0 if already expired),
+        or None if no batches are leased ie. the run is done
+        """
+        leased = list(self.db.ingest_queue.find({ 'queue': self.queue, 'status': 'leased' }).sort([('lease_expires', pymongo.ASCENDING)]).limit(1))
+        if len(leased) == 0:
+            return None
+        return max(0.0, (leased[0].get('lease_expires') - datetime.utcnow()).total_seconds())
+
+    def heartbeat(self, batch):
+        """
+        Extend the lease on batch once half of it has elapsed. Cheap enough to call before each fetch.
+        """
+        if self.last_renewed is not None and time.monotonic() - self.last_renewed < self.lease_seconds / 2:
+            return
+        self.last_renewed = time.monotonic()
+        self.db.ingest_queue.update_one({ 'queue': self.queue, 'batch': batch.get('batch'), 'owner': self.worker_id },
+                                        { '$set': { 'lease_expires': datetime.utcnow() + timedelta(seconds=self.lease_seconds) }})
+
+    def complete(self, batch, retry=None):
+        """
+        Mark batch as done, or if any stocks are to be retried put it back in the queue with just those stocks, and
+        return the number of batches in the run which are not yet done
+        """
+        if retry:
+            update = { '$set': { 'status': 'pending', 'stocks': sorted(retry) }, '$unset': { 'owner': '', 'lease_expires': '' }}
+        else:
+            update = { '$set': { 'status': 'done', 'finished': datetime.utcnow() }}
+        result = self.db.ingest_queue.update_one({ 'queue': self.queue, 'batch': batch.get('batch'), 'owner': self.worker_id }, update)
+        if result.matched_count == 0:  # NB: our lease expired and someone else has it, but the upserts are idempotent so no harm done
+            print("WARNING: batch {} of {} was reclaimed by another worker before we completed it".format(batch.get('batch'), self.queue))
+        return self.db.ingest_queue.count_documents({ 'queue': self.queue, 'status': { '$ne': 'done' } })
+
+thread_state = threading.local()
+
+def thread_fetcher():
+    # requests.Session is not guaranteed thread-safe, so each worker thread gets its own (with the same retry strategy)
+    fetcher = getattr(thread_state, 'fetcher', None)
+    if fetcher is None:
+        fetcher = get_fetcher()
+        thread_state.fetcher = fetcher
+    return fetcher
+
+def fetch_all(stocks, fetch_fn, config, rate_limiter=None):
+    """
+    Call fetch_fn(asx_code, rate_limiter) for each stock using a bounded pool of config['fetch_workers'] threads,
+    yielding (asx_code, result) as each fetch completes. All threads share one rate limiter of
+    config['requests_per_second'] so the endpoint sees the same load regardless of the number of workers. Pass
+    rate_limiter (eg. a MongoRateLimiter) to share the budget with other processes as well.
+    """
+    n_workers = int(config.get('fetch_workers', 4))
+    assert n_workers >= 1
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(config.get('requests_per_second', 2))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = { pool.submit(fetch_fn, asx_code, rate_limiter): asx_code for asx_code in stocks }
+        for f in as_completed(futures):
+            asx_code = futures[f]
+            try:
+                yield (asx_code, f.result())
+            except Exception as e:
+                print("WARNING: unable to fetch data for {} -- ignored.".format(asx_code))
+                print(str(e))
+                yield (asx_code, None)
+
+def price_doc(body, fetch_date):
+    """
+    Return the asx_prices document for the body of a quote response
+    """
+    d = json.loads(body)
+    d.update({ 'fetch_date': fetch_date })
+    for key in ['last_trade_date', 'year_high_date', 'year_low_date']:
+        if key in d:
+            d[key] = parse_asx_datetime(d[key])
+    #assert len(d.keys()) > 10
+    return d
 
+def fetch_price(asx_code, config, fetch_date, rate_limiter, price_writer, blacklist_writer, journal, archive):
+    """
+    Fetch and return the current quote for asx_code or None if it could not be fetched. Writes are queued with the
+    supplied BulkWriter's: price_writer must journal its writes (see RunJournal.record_writes()). Called concurrently from update_prices() so all state must be local or thread-safe.
+    """
+    url = "{}{}{}".format(config.get('asx_prices'), '' if config.get('asx_prices').endswith('/') else '/', asx_code)
+    print("Fetching {} prices from {}".format(asx_code, url))
+    start = None
+    try:
+        rate_limiter.acquire()  # be nice to the API endpoint
+        start = time.monotonic()
+        resp = thread_fetcher().get(url, timeout=(30,30))
+        body = resp.content.decode() # NB: archive exactly what is parsed, so a replay gives the same document
+        archive.add(asx_code, fetch_date, resp.status_code, body)
+        if resp.status_code != 200:
+            if resp.status_code == 404:   # not found? ok, add it to blacklist... but we will check it again in future in case API broken...
+                blacklist_writer.add(UpdateOne({ 'asx_code': asx_code },
+                                               { "$set": { 'asx_code': asx_code,
+                                                           'reason': "404 for {}".format(url),
+                                                           'valid_until': datetime.utcnow() + timedelta(days=randint(30, 60)) }},
+                                               upsert=True))
+            raise ValueError("Got non-OK status for {}: {}".format(url, resp.status_code))
+        d = price_doc(body, fetch_date)
+    except Exception as e:
+        print("WARNING: unable to fetch data for {} -- ignored.".format(asx_code))
+        print(str(e))
+        journal.record(asx_code, 'failed', latency=time.monotonic() - start if start is not None else None, error=str(e))
+        return None
+    # NB: journalled as ok (or failed) by price_writer's on_write once the batch with this quote has been written
+    try:
+        price_writer.add(UpdateOne({ 'asx_code': asx_code, 'fetch_date': fetch_date }, { '$set': d }, upsert=True),
+                         key=(asx_code, time.monotonic() - start))
+    except Exception as e:
+        print("WARNING: unable to save prices for batch ending with {}: {}".format(asx_code, str(e)))
+    return d
 
-def update_prices(db, available_stocks, config, fetch_date, ensure_indexes=True):
+def update_prices(db, available_stocks, config, fetch_date, ensure_indexes=True, journal=None):
     assert isinstance(config, dict)
     #assert len(available_stocks) > 10 # dont do this anymore, since we might have to refetch a few failed stocks
 
     if ensure_indexes:
         db.asx_prices.create_index([('asx_code', pymongo.ASCENDING), ('fetch_date', pymongo.ASCENDING)], unique=True)
 
-    fetcher = get_fetcher()
-    df = None
     print("Updating stock prices for {}".format(fetch_date))
-    for asx_code in available_stocks:
-        url = "{}{}{}".format(config.get('asx_prices'), '' if config.get('asx_prices').endswith('/') else '/', asx_code)
-        print("Fetching {} prices from {}".format(asx_code, url))
-        already_fetched_doc = db.asx_prices.find_one({ 'asx_code': asx_code, 'fetch_date': fetch_date })
-        if already_fetched_doc is not None:
-            print("Already got data for ASX {}".format(asx_code))
-            continue
-        try:
-            resp = fetcher.get(url, timeout=(30,30))
-            if resp.status_code != 200:
-                if resp.status_code == 404:   # not found? ok, add it to blacklist... but we will check it again in future in case API broken...
-                    db.asx_blacklist.find_one_and_update({ 'asx_code': asx_code },
-                                                         { "$set": { 'asx_code': asx_code,
-                                                                     'reason': "404 for {}".format(url),
-                                                                     'valid_until': datetime.utcnow() + timedelta(days=randint(30, 60)) }},
-                                                         upsert=True)
-                raise ValueError("Got non-OK status for {}: {}".format(url, resp.status_code))
-            d = json.loads(resp.content.decode())
-            d.update({ 'fetch_date': fetch_date })
-            for key in ['last_trade_date', 'year_high_date', 'year_low_date']:
-                if key in d:
-                    d[key] = dateutil.parser.parse(d[key]) # NB: gonna be slow since the auto-format magic has to do it thing... but safer for common formats
-            #assert len(d.keys()) > 10
-            if df is None:
-                df = pd.DataFrame(columns=d.keys())
-            row = pd.Series(d, name=asx_code)
-            df = df.append(row)
-            db.asx_prices.find_one_and_update({ 'asx_code': asx_code, 'fetch_date': fetch_date }, { '$set': d }, upsert=True)
-        except Exception as e:
-            print("WARNING: unable to fetch data for {} -- ignored.".format(asx_code))
-            print(str(e))
-        time.sleep(5)  # be nice to the API endpoint
+    # one query up front, rather than one per stock, to skip stocks we already have (eg. when topping up failed fetches)
+    already_fetched = set(db.asx_prices.distinct('asx_code', { 'fetch_date': fetch_date }))
+    stocks_to_fetch = [asx_code for asx_code in available_stocks if not asx_code in already_fetched]
+    print("Already got data for {} stocks, {} remain to be fetched.".format(len(available_stocks) - len(stocks_to_fetch), len(stocks_to_fetch)))
+    batch_size = int(config.get('write_batch_size', 100))
+    resumed = journal is not None
+    if journal is None:
+        journal = RunJournal(db, 'prices', fetch_date, batch_size=batch_size)
+    journal.start(available_stocks)
+    for asx_code in already_fetched.intersection(available_stocks):
+        journal.record(asx_code, 'skipped')
+    saved = set()
+    def on_write(keys, error):
+        journal.record_writes(keys, error)
+        if error is None:
+            saved.update([asx_code for asx_code, latency in keys])
+    with BulkWriter(db.asx_prices, batch_size, on_write=on_write) as price_writer, \
+         BulkWriter(db.asx_blacklist, batch_size) as blacklist_writer, \
+         ResponseArchive(config, 'prices', fetch_date) as archive:
+        fetch_fn = lambda asx_code, rate_limiter: fetch_price(asx_code, config, fetch_date, rate_limiter,
+                                                              price_writer, blacklist_writer, journal, archive)
+        fetched = dict(fetch_all(stocks_to_fetch, fetch_fn, config))
+    journal.finish()
+    print("Wrote {} quotes to asx_prices in batches of {}".format(price_writer.n_written, batch_size))
+    if price_writer.n_written == 0:
+        print("No new prices fetched for {}: nothing to save.".format(fetch_date))
+        return
+    if resumed or len(already_fetched) > 0:
+        # NB: the TSV is the whole day (--backfill restores from it), not just the stocks fetched by this run
+        save_prices_from_db(db, config, fetch_date)
+        return
+    rows = ColumnBuffer()
+    for asx_code in stocks_to_fetch:  # NB: fetches complete in any order, but rows are saved in the order requested
+        d = fetched.get(asx_code)
+        if d is not None and asx_code in saved:
+            rows.append(d, asx_code)
+    save_prices(db, rows.to_dataframe(), config, fetch_date)
+
+def save_prices_from_db(db, config, fetch_date):
+    """
+    Save the TSV for fetch_date (see save_prices()) from every quote for the day in asx_prices
+    """
+    rows = ColumnBuffer()
+    for d in db.asx_prices.find({ 'fetch_date': fetch_date }, { '_id': 0 }).sort([('asx_code', pymongo.ASCENDING)]):
+        rows.append(d, d.pop('asx_code'))
+    if len(rows) > 0:
+        save_prices(db, rows.to_dataframe(), config, fetch_date)
+
+def save_prices(db, df, config, fetch_date):
     fname = "{}/asx_prices/prices.{}.tsv".format(config.get('data_root'), fetch_date)
     df.to_csv(fname, sep='\t')
-    validate_prices(df)
+    validate_prices(df, db=db, fetch_date=fetch_date, max_jump=float(config.get('max_price_jump', 0.5)))
     print("Saved {} stock codes with prices to {}".format(len(df), fname))
 
-def available_stocks(db, config):
+def run_worker(db, config, kind, fetch_date, stocks, worker_id=None):
+    """
+    Fetch prices or company details (kind) for fetch_date as one of several cooperating workers: batches of stocks are
+    claimed from a WorkQueue until none remain and requests are subject to the global config['requests_per_second']
+    budget shared by all workers. All workers journal to the same run. Stocks which fail are put back in the queue
+    until they have been tried config['max_fetch_attempts'] times. The worker which completes the last batch (and wins
+    RunJournal.claim_finish()) finishes the run and, for prices, saves the TSV for the day from asx_prices, since no
+    single worker has all the quotes. Returns True if this worker completed the run.
+
+    The queue and run are per (kind, fetch_date), so running --worker again for a completed day does nothing: stocks
+    which still failed are fetched by --resume without --worker, which resumes the sharded run.
+    """
+    assert kind in ('prices', 'details')
+    assert isinstance(config, dict)
+    batch_size = int(config.get('write_batch_size', 100))
+    max_attempts = int(config.get('max_fetch_attempts', 3))
+    queue = WorkQueue(db, kind, fetch_date, worker_id=worker_id, lease_seconds=int(config.get('lease_seconds', 600)))
+    queue.populate(stocks, int(config.get('work_batch_size', 50)))
+    rate_limiter = MongoRateLimiter(db, 'asx', config.get('requests_per_second', 2))
+    journal = RunJournal(db, kind, fetch_date, run_id="{}-{}-sharded".format(kind, fetch_date), batch_size=batch_size)
+    if kind == 'prices':
+        db.asx_prices.create_index([('asx_code', pymongo.ASCENDING), ('fetch_date', pymongo.ASCENDING)], unique=True)
+    else:
+        db.asx_company_details.create_index([ ('asx_code', pymongo.ASCENDING, ), ], unique=True)
+    print("Worker {} joining {} run for {}".format(queue.worker_id, kind, fetch_date))
+    n_batches = 0
+    remaining = None
+    while True:
+        batch = queue.claim()
+        if batch is None:
+            # wait for batches leased by other workers: if one of them dies, its batch must still be done by someone
+            wait = queue.wait_time()
+            if wait is None:
+                break
+            time.sleep(min(wait + 1.0, 30.0))
+            continue
+        batch_stocks = batch.get('stocks')
+        journal.start(batch_stocks)
+        if kind == 'prices':
+            already_fetched = set(db.asx_prices.distinct('asx_code', { 'fetch_date': fetch_date, 'asx_code': { '$in': batch_stocks } }))
+            todo = [asx_code for asx_code in batch_stocks if not asx_code in already_fetched]
+        else:
+            todo = stale_company_details(db, batch_stocks)
+        for asx_code in set(batch_stocks).difference(todo):
+            journal.record(asx_code, 'skipped')
+        with BulkWriter(db.asx_prices if kind == 'prices' else db.asx_company_details, batch_size, on_write=journal.record_writes) as writer, \
+             BulkWriter(db.asx_blacklist, batch_size) as blacklist_writer, ResponseArchive(config, kind, fetch_date) as archive:
+            def fetch_fn(asx_code, rate_limiter):
+                queue.heartbeat(batch)
+                if kind == 'prices':
+                    return fetch_price(asx_code, config, fetch_date, rate_limiter, writer, blacklist_writer, journal, archive)
+                return fetch_company_details(asx_code, config, rate_limiter, writer, journal, archive)
+            for asx_code, d in fetch_all(todo, fetch_fn, config, rate_limiter=rate_limiter):
+                pass
+        # NB: only mark the batch done once its writes are flushed, so a crash before here means the batch is refetched
+        journal.flush()
+        retry = [rec.get('asx_code') for rec in db.ingest_journal.find({ 'run_id': journal.run_id, 'asx_code': { '$in': todo },
+                                                                          'status': 'failed', 'attempts': { '$lt': max_attempts } })]
+        remaining = queue.complete(batch, retry=retry)
+        n_batches += 1
+        print("Worker {} completed batch {} ({} stocks, {} to retry): {} batches remain".format(queue.worker_id, batch.get('batch'),
+                                                                                                len(batch_stocks), len(retry), remaining))
+    # NB: the count of remaining batches is not atomic with completing ours, so two workers may both see 0
+    finishing = remaining == 0 and journal.claim_finish()
+    if finishing:
+        journal.finish()
+    else:
+        journal.flush()
+    print("Worker {} completed {} batches".format(queue.worker_id, n_batches))
+    if kind == 'prices' and finishing:
+        save_prices_from_db(db, config, fetch_date)
+    return finishing
+
+def refresh_matrices(db, config, fetch_date):
+    """
+    Incrementally update the monthly matrices for fetch_date (see persist_dataframes.refresh_prices()) so they are
+    available as soon as prices are ingested. Disabled if config['refresh_matrices'] is false.
+    """
+    if not config.get('refresh_matrices', True):
+        return
+    day = datetime.strptime(fetch_date, "%Y-%m-%d")
+    persist_dataframes.set_matrix_encoding(config.get('matrix_codec', 'gzip'), config.get('matrix_float32', False))
+    with metrics.phase('matrices'):
+        persist_dataframes.refresh_prices(db, day.month, day.year)
+
+def available_stocks(db, config, for_prices=True):
     assert config is not None
     # only variants which include ORDINARY FULLY PAID/STAPLED SECURITIES eg. SYD
     stocks = [re.compile('.*ORDINARY.*'), re.compile('^EXCHANGE\s+TRADED\s+FUND.*$')]
-    ret = set()
-    for security_type in stocks:
-       tmp = set([r.get('asx_code') for r in db.asx_isin.find({ 'security_name': security_type })
-                                              if db.asx_blacklist.find_one({'asx_code': r.get('asx_code'),
-                                                                            'valid_until': { '$gt': datetime.utcnow() }}) is None])
-       ret = ret.union(tmp)
+    ret = set(db.asx_isin.distinct('asx_code', { 'security_name': { '$in': stocks } }))
+    # load the active blacklist once, rather than a query per security
+    blacklisted = set(db.asx_blacklist.distinct('asx_code', { 'valid_until': { '$gt': datetime.utcnow() } }))
+    print("Excluding {} blacklisted securities from {} found".format(len(blacklisted.intersection(ret)), len(ret)))
+    ret = ret.difference(blacklisted)
     exclude_stocks_without_details = config.get('exclude_stocks_without_details', False)
     exclude_stocks_with_zero_volume = config.get('exclude_zero_volume_stocks', False)
     if exclude_stocks_without_details: # will exclude if True nearly 1000 securities, so use with care
@@ -163,62 +1060,269 @@ def available_stocks(db, config):
         print("Eliminating securities without company details: found {} to check".format(len(ret)))
         ret = ret.intersection(details_stocks)
         # FALLTHRU...
+    if exclude_stocks_with_zero_volume and for_prices: # NB: only price runs may skip (and reschedule the probe of) dormant stocks
+        skipped = zero_volume_stocks_to_skip(db, config, ret)
+        print("Eliminating {} securities with zero volume over the past {} days".format(len(skipped), config.get('zero_volume_window_days', 30)))
+        ret = ret.difference(skipped)
     print("Found {} suitable stocks on ASX...".format(len(ret)))
     return sorted(ret)
 
-def update_blacklist(db, config):
+def zero_volume_stocks(db, config, today=None):
+    """
+    Return the set of stocks which had zero volume on every day they were quoted over the trailing
+    config['zero_volume_window_days'] (30 by default), according to the volume matrices persisted by persist_dataframes.py
+    Stocks without any quote in the window are not included, as we have no evidence they are dormant.
+    """
+    if today is None:
+        today = date.today()
+    window = int(config.get('zero_volume_window_days', 30))
+    assert window > 0
+    wanted_dates = set([str(today - timedelta(days=i)) for i in range(window)])
+    tags = set(["volume-{}-{}-asx".format(d[5:7], d[0:4]) for d in wanted_dates])
+    matrices = []
+    for rec in db.market_quote_cache.find({ 'tag': { '$in': list(tags) }, 'scope': 'all-downloaded', 'dataframe_format': 'parquet' },
+                                          { 'dataframe': 1, 'gridfs_id': 1 }):
+        df = persist_dataframes.read_matrix(db, rec)
+        matrices.append(df[[d for d in df.columns if d in wanted_dates]])
+    if len(matrices) == 0:
+        print("WARNING: no volume matrices available for the past {} days, so no zero volume stocks found".format(window))
+        return set()
+    volume_df = pd.concat(matrices, axis=1)
+    n_quoted_days = volume_df.notnull().sum(axis=1)
+    total_volume = volume_df.sum(axis=1)  # NB: ignores NaN
+    return set(volume_df.index[(n_quoted_days > 0) & (total_volume == 0)])
+
+def zero_volume_stocks_to_skip(db, config, candidates):
+    """
+    Return the subset of candidates to skip since they have traded nothing recently. Like the blacklist, each dormant
+    stock is given a randomised valid_until (in db.asx_zero_volume) after which it is fetched once more to see if it
+    has started trading again, so that re-probes are spread out over the days rather than all at once.
+    """
+    dormant = zero_volume_stocks(db, config).intersection(candidates)
+    now = datetime.utcnow()
+    skip_until = { r.get('asx_code'): r.get('valid_until') for r in db.asx_zero_volume.find({}, { 'asx_code': 1, 'valid_until': 1 }) }
+    skip = set()
+    ops = []
+    for asx_code in dormant:
+        valid_until = skip_until.get(asx_code)
+        if valid_until is not None and valid_until > now:
+            skip.add(asx_code)
+            continue
+        if valid_until is None: # newly dormant: skip it, otherwise it has expired and will be re-probed today
+            skip.add(asx_code)
+        ops.append(UpdateOne({ 'asx_code': asx_code },
+                             { '$set': { 'asx_code': asx_code, 'reason': 'zero volume',
+                                         'valid_until': now + timedelta(days=randint(7, 21)) }}, upsert=True))
+    trading_again = set(skip_until.keys()).difference(dormant)
+    if len(trading_again) > 0:
+        ops.append(DeleteMany({ 'asx_code': { '$in': list(trading_again) }}))
+    if len(ops) > 0:
+        db.asx_zero_volume.bulk_write(ops, ordered=False)
+    return skip
+
+def update_blacklist(db, config, min_failed_fetches=20):
     assert db is not None
-    bad_codes = {}
-    for bad in db.asx_prices.find({ 'error_code': 'id-or-code-invalid'}):
-        asx_code = bad.get('asx_code')
-        if not asx_code in bad_codes:
-            bad_codes[asx_code] = set()
-        bad_codes[asx_code].add(bad['fetch_date'])
-    for_blacklisting = [code for code, dates in bad_codes.items() if len(dates) > 20]
-    print("Identified {} stocks for blacklisting with over 20 failed fetches".format(len(for_blacklisting)))
+    # count distinct failed fetch dates per stock server-side, so only the stocks to blacklist are transferred
+    for_blacklisting = [rec.get('_id') for rec in db.asx_prices.aggregate([
+                            { '$match': { 'error_code': 'id-or-code-invalid' } },
+                            { '$group': { '_id': '$asx_code', 'fetch_dates': { '$addToSet': '$fetch_date' } } },
+                            { '$project': { 'n_failed': { '$size': '$fetch_dates' } } },
+                            { '$match': { 'n_failed': { '$gt': min_failed_fetches } } } ], allowDiskUse=True)]
+    print("Identified {} stocks for blacklisting with over {} failed fetches".format(len(for_blacklisting), min_failed_fetches))
+    ops = []
     for code in for_blacklisting:
-        db.asx_blacklist.find_one_and_update({ 'asx_code': code },
-                        { '$set': { 'asx_code': code, 'reason': 'asxtrade.py says no' }},
-                        upsert=True)
+        # like fix_blacklist(), randomise when each entry expires so that they are not all re-checked on the same day
+        future_date = datetime.today().date() + timedelta(days=randint(30, 90))
+        ops.append(UpdateOne({ 'asx_code': code },
+                             { '$set': { 'asx_code': code, 'reason': 'asxtrade.py says no',
+                                         'valid_until': datetime.combine(future_date, datetime.min.time()) }},
+                             upsert=True))
+    if len(ops) > 0:
+        db.asx_blacklist.bulk_write(ops, ordered=False)
     print("Blacklist updated.")
 
-def update_company_details(db, available_stocks, config, ensure_indexes=False):
-    assert len(available_stocks) > 10
+def stale_company_details(db, available_stocks, max_age=timedelta(days=7)):
+    """
+    Return those of available_stocks (in the same order) with no company details or details older than max_age, using one
+    query rather than one per stock. Records saved before we stored fetched_at are dated by their ObjectId.
+    """
+    cutoff = datetime.utcnow() - max_age
+    fresh = set(db.asx_company_details.distinct('asx_code', {
+                    'asx_code': { '$in': list(available_stocks) },
+                    '$or': [ { 'fetched_at': { '$gte': cutoff } },
+                             { 'fetched_at': { '$exists': False }, '_id': { '$gte': ObjectId.from_datetime(cutoff) } } ] }))
+    return [asx_code for asx_code in available_stocks if not asx_code in fresh]
+
+def details_doc(body, asx_code, fetched_at):
+    """
+    Return the asx_company_details document for the body of a company details response, or None if the ASX
+    reports asx_code as invalid
+    """
+    d = json.loads(body)
+    d.update({ 'asx_code': asx_code })
+    if 'error_desc' in d:
+        print("WARNING: ignoring {} ASX code as it is not a valid code".format(asx_code))
+        print(d)
+        return None
+    assert d.pop('code', None) == asx_code
+    d.update({ 'fetched_at': fetched_at })
+    return d
+
+def fetch_company_details(asx_code, config, rate_limiter, details_writer, journal, archive):
+    """
+    Fetch the company details for asx_code and queue them for saving with details_writer, returning the details or None
+    if they could not be fetched. Called concurrently from update_company_details() so all state must be local or thread-safe.
+    """
+    url = config.get('asx_company_details')
+    url = url.replace('%s', asx_code)
+    print(url)
+    start = None
+    try:
+        rate_limiter.acquire()  # be nice to the API endpoint
+        start = time.monotonic()
+        resp = thread_fetcher().get(url, timeout=(30,30))
+        body = resp.content.decode()
+        archive.add(asx_code, archive.fetch_date, resp.status_code, body)
+        d = details_doc(body, asx_code, datetime.utcnow())
+        if d is None:
+            journal.record(asx_code, 'failed', latency=time.monotonic() - start, error='invalid code')
+            return None
+    except Exception as e:
+        print(str(e))
+        journal.record(asx_code, 'failed', latency=time.monotonic() - start if start is not None else None, error=str(e))
+        return None
+    # NB: journalled once written, as for fetch_price()
+    try:
+        details_writer.add(ReplaceOne({ 'asx_code': asx_code }, d, upsert=True), key=(asx_code, time.monotonic() - start))
+    except Exception as e:
+        print("WARNING: unable to save company details for batch ending with {}: {}".format(asx_code, str(e)))
+    return d
+
+def update_company_details(db, available_stocks, config, ensure_indexes=False, journal=None, fetch_date=None):
+    assert len(available_stocks) > 10 or journal is not None # resumed runs may have only a few stocks left
     assert db is not None
     assert isinstance(config, dict)
-    fetcher = get_fetcher()
 
     if ensure_indexes:
         db.asx_company_details.create_index([ ('asx_code', pymongo.ASCENDING, ), ], unique=True)
+    batch_size = int(config.get('write_batch_size', 100))
+    if fetch_date is None:
+        fetch_date = journal.fetch_date if journal is not None else datetime.now().strftime("%Y-%m-%d")
+    if journal is None:
+        journal = RunJournal(db, 'details', fetch_date, batch_size=batch_size)
+    assert journal.fetch_date == fetch_date
+    journal.start(available_stocks)
 
-    for asx_code in available_stocks:
-        url = config.get('asx_company_details')
-        url = url.replace('%s', asx_code)
-        print(url)
-        # rec should only have one record since we remove&insert per asx_code below...
-        rec = [r for r in db.asx_company_details.find({ 'asx_code': asx_code }).sort([('_id', pymongo.ASCENDING)]).limit(50)]
-        if len(rec) > 0:
-            #print(rec)
-            dt = rec[-1].get('_id').generation_time
-            #print(dt)
-            if datetime.now(timezone.utc) < dt + timedelta(days=7):  # existing record less than a week old? if so, ignore it
-                print("Ignoring {} as record is less than a week old.".format(asx_code))
-                continue
-        resp = fetcher.get(url, timeout=(30,30))
-        try:
-            d = resp.json()
-            d.update({ 'asx_code': asx_code })
-            if 'error_desc' in d:
-                print("WARNING: ignoring {} ASX code as it is not a valid code".format(asx_code))
-                print(d)
-            else:
-                assert d.pop('code', None) == asx_code
-                db.asx_company_details.delete_one({ 'asx_code': asx_code })
-                db.asx_company_details.insert_one(d) # ensure new _id is assigned with current date
-        except Exception as e:
-            print(str(e))
-            pass
-        time.sleep(5)
+    stale_stocks = stale_company_details(db, available_stocks)
+    print("Ignoring {} stocks as their details are less than a week old.".format(len(available_stocks) - len(stale_stocks)))
+    for asx_code in set(available_stocks).difference(stale_stocks):
+        journal.record(asx_code, 'skipped')
+    with BulkWriter(db.asx_company_details, batch_size, on_write=journal.record_writes) as details_writer, \
+         ResponseArchive(config, 'details', journal.fetch_date) as archive:
+        fetch_fn = lambda asx_code, rate_limiter: fetch_company_details(asx_code, config, rate_limiter, details_writer, journal, archive)
+        n = len([d for asx_code, d in fetch_all(stale_stocks, fetch_fn, config) if d is not None])
+    journal.finish()
+    print("Updated company details for {} stocks.".format(n))
+
+def replay_archive(db, config, from_date, to_date):
+    """
+    Rebuild asx_prices and asx_company_details from the raw responses archived (see ResponseArchive) for each
+    day in [from_date, to_date] inclusive, without touching the network. Only successful responses are replayed.
+    """
+    batch_size = int(config.get('write_batch_size', 100))
+    n_prices = n_details = 0
+    with BulkWriter(db.asx_prices, batch_size) as price_writer, BulkWriter(db.asx_company_details, batch_size) as details_writer:
+        for day in pd.date_range(from_date, to_date, freq='D'):
+            fetch_date = day.strftime("%Y-%m-%d")
+            path = archive_path(config, 'prices', fetch_date)
+            if os.path.exists(path):
+                for rec in read_archive(path):
+                    if rec.get('status') != 200:
+                        continue
+                    d = price_doc(rec.get('body'), rec.get('fetch_date'))
+                    price_writer.add(UpdateOne({ 'asx_code': rec.get('asx_code'), 'fetch_date': rec.get('fetch_date') }, { '$set': d }, upsert=True))
+                    n_prices += 1
+            path = archive_path(config, 'details', fetch_date)
+            if os.path.exists(path):
+                for rec in read_archive(path):
+                    if rec.get('status') != 200:
+                        continue
+                    d = details_doc(rec.get('body'), rec.get('asx_code'), datetime.fromisoformat(rec.get('fetched_at')))
+                    if d is not None:
+                        details_writer.add(ReplaceOne({ 'asx_code': rec.get('asx_code') }, d, upsert=True))
+                        n_details += 1
+    print("Replayed {} quotes and {} company details from {} to {}".format(n_prices, n_details, from_date, to_date))
+
+# types of the columns in data_root/asx_prices/prices.<date>.tsv, so that backfilled documents match those saved by update_prices()
+price_tsv_float_fields = ['last_price', 'open_price', 'day_high_price', 'day_low_price', 'change_price', 'bid_price',
+                          'offer_price', 'previous_close_price', 'year_high_price', 'year_low_price', 'pe', 'eps',
+                          'annual_dividend_yield']
+price_tsv_int_fields = ['volume', 'average_daily_volume', 'market_cap', 'number_of_shares', 'deprecated_market_cap',
+                        'deprecated_number_of_shares']
+price_tsv_date_fields = ['last_trade_date', 'year_high_date', 'year_low_date']
+price_tsv_dtypes = dict([(field, float) for field in price_tsv_float_fields + price_tsv_int_fields] +
+                        [(field, str) for field in ['code', 'isin_code', 'desc_full', 'change_in_percent', 'fetch_date', 'error_code',
+                                                    'error_desc', 'previous_day_percentage_change', 'suspended'] + price_tsv_date_fields])
+
+def read_prices_tsv(fname):
+    """
+    Return the asx_prices documents saved in the specified prices.<date>.tsv by update_prices()
+    """
+    df = pd.read_csv(fname, sep='\t', index_col=0, dtype=price_tsv_dtypes, keep_default_na=False, na_values=[''])
+    df.index = df.index.astype(str)
+    for field in price_tsv_date_fields:
+        if field in df.columns:
+            df[field] = pd.to_datetime(df[field], utc=True)
+    if 'suspended' in df.columns:
+        df['suspended'] = df['suspended'].map({ 'True': True, 'False': False })
+    docs = []
+    for asx_code, row in zip(df.index, df.to_dict('records')):
+        d = { k: v for k, v in row.items() if not (v is None or v is pd.NaT or (isinstance(v, float) and np.isnan(v))) }
+        for field in price_tsv_int_fields:
+            if field in d:
+                d[field] = int(d[field])
+        for field in price_tsv_date_fields:
+            if field in d:
+                d[field] = d[field].to_pydatetime()
+        d.update({ 'asx_code': asx_code })
+        docs.append(d)
+    return docs
+
+def backfill_prices(db, config, from_date, to_date, n_readers=4, batch_size=1000):
+    """
+    Load the prices.<date>.tsv files in data_root/asx_prices for [from_date, to_date] into asx_prices, skipping
+    (asx_code, fetch_date) keys already present. Files are read in parallel and inserted with unordered insert_many()
+    batches so that the (asx_code, fetch_date) unique index rejects any duplicates without stopping the batch.
+    """
+    db.asx_prices.create_index([('asx_code', pymongo.ASCENDING), ('fetch_date', pymongo.ASCENDING)], unique=True)
+    fnames = []
+    for day in pd.date_range(from_date, to_date, freq='D'):
+        fname = "{}/asx_prices/prices.{}.tsv".format(config.get('data_root'), day.strftime("%Y-%m-%d"))
+        if os.path.exists(fname):
+            fnames.append((day.strftime("%Y-%m-%d"), fname))
+    print("Found {} price files to backfill from {} to {}".format(len(fnames), from_date, to_date))
+    n_inserted = n_skipped = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=n_readers) as pool:
+        for fetch_date, docs in zip([fetch_date for fetch_date, fname in fnames], pool.map(read_prices_tsv, [fname for fetch_date, fname in fnames])):
+            existing = set(db.asx_prices.distinct('asx_code', { 'fetch_date': fetch_date }))
+            n_read = len(docs)
+            docs = [d for d in docs if d.get('fetch_date') == fetch_date and not d.get('asx_code') in existing]
+            n_skipped += n_read - len(docs)
+            for i in range(0, len(docs), batch_size):
+                batch = docs[i:i+batch_size]
+                try:
+                    db.asx_prices.insert_many(batch, ordered=False)
+                    n_inserted += len(batch)
+                except BulkWriteError as e:
+                    errors = e.details.get('writeErrors', [])
+                    if any([err.get('code') != 11000 for err in errors]):  # anything other than duplicate keys is fatal
+                        raise
+                    n_inserted += e.details.get('nInserted', 0)
+                    n_skipped += len(errors)
+            print("Backfilled {} prices for {}".format(len(docs), fetch_date))
+    elapsed = time.monotonic() - start
+    print("Inserted {} prices ({} already present) in {:.1f} seconds: {:.0f} rows/sec".format(n_inserted, n_skipped, elapsed, n_inserted / elapsed if elapsed > 0 else 0))
 
 def fix_blacklist(db, config):
     updates = {}
@@ -241,10 +1345,15 @@ if __name__ == "__main__":
     args.add_argument('--want-isin', help="Update securities list", action="store_true")
     args.add_argument('--want-prices', help="Update ASX stock price list with current data", action="store_true")
     args.add_argument('--want-details', help="Update ASX company details (incl. dividend, annual report etc.) with current data", action="store_true")
-    args.add_argument('--validate', help="", action="store_true")
+    args.add_argument('--validate', help="Validate the prices.<date>.tsv for --date (default today) and save the report", action="store_true")
+    args.add_argument('--export-expectations', help="Save the --validate checks as a great_expectations suite", action="store_true")
     args.add_argument('--fix-blacklist', help="Ensure each blacklist entry has a valid_until date", action="store_true")
     args.add_argument('--date', help="Date to use as the record date in the database [YYYY-mm-dd]", type=str, required=False)
     args.add_argument('--stocks', help="JSON array with stocks to load for --want-prices", type=str, required=False)
+    args.add_argument('--replay', help="Rebuild prices and company details from the raw response archive for dates [YYYY-mm-dd[:YYYY-mm-dd]]", type=str, required=False)
+    args.add_argument('--backfill', help="Load prices.<date>.tsv files under data_root into the database for dates [YYYY-mm-dd[:YYYY-mm-dd]]", type=str, required=False)
+    args.add_argument('--worker', help="Run --want-prices/--want-details as one of several cooperating workers sharing a work queue in the database (use --resume without --worker to refetch stocks which still failed)", action="store_true")
+    args.add_argument('--resume', help="Fetch only the failed or untried stocks from the last --want-prices/--want-details run for the date", action="store_true")
     a = args.parse_args()
 
     config = {}
@@ -255,46 +1364,97 @@ if __name__ == "__main__":
     password = m.get('password')
     if password.startswith('$'):
         password = os.getenv(password[1:])
-    mongo = pymongo.MongoClient(m.get('host'), m.get('port'), username=m.get('user'), password=password)
+    mongo = pymongo.MongoClient(m.get('host'), m.get('port'), username=m.get('user'), password=password,
+                                event_listeners=[MongoMetricsListener()])
     db = mongo[m.get('db')]
+    started = datetime.utcnow()
 
     if a.blacklist:
-        update_blacklist(db, config)
+        with metrics.phase('blacklist'):
+            update_blacklist(db, config)
 
     if a.want_companies:
         print("**** UPDATING ASX COMPANIES")
-        update_companies(db, config, ensure_indexes=True)
+        with metrics.phase('companies'):
+            update_companies(db, config, ensure_indexes=True)
     if a.want_isin:
         print("**** UPDATING ASX SECURITIES")
-        update_isin(db, config, ensure_indexes=True)
+        with metrics.phase('isin'):
+            update_isin(db, config, ensure_indexes=True)
     if a.fix_blacklist:
         print("*** FIX BLACKLIST ENTRIES")
         fix_blacklist(db, config)
+    if a.replay:
+        print("*** REPLAYING RAW RESPONSE ARCHIVE")
+        dates = a.replay.split(':')
+        assert len(dates) in (1, 2)
+        assert all([re.match(r"^\d{4}-\d{2}-\d{2}$", d) for d in dates])
+        replay_archive(db, config, dates[0], dates[-1])
+    if a.backfill:
+        print("*** BACKFILLING PRICES")
+        dates = a.backfill.split(':')
+        assert len(dates) in (1, 2)
+        assert all([re.match(r"^\d{4}-\d{2}-\d{2}$", d) for d in dates])
+        backfill_prices(db, config, dates[0], dates[-1], batch_size=max(1000, int(config.get('write_batch_size', 100))))
 
     if any([a.want_prices, a.want_details]):
         if a.stocks:
            with open(a.stocks, 'r') as fp:
-               stocks_to_fetch = json.loads(fp.read())
+               price_stocks = json.loads(fp.read())
+           details_stocks = price_stocks
+        else:
+           price_stocks = available_stocks(db, config) if a.want_prices else []
+           details_stocks = available_stocks(db, config, for_prices=False) if a.want_details else []
+        print("Found {} stocks to fetch.".format(len(set(price_stocks).union(details_stocks))))
+        if a.date:
+           import re
+           pattern = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+           assert pattern.match(a.date)
+           fetch_date = a.date
         else:
-           stocks_to_fetch = available_stocks(db, config)
-        print("Found {} stocks to fetch.".format(len(stocks_to_fetch)))
-        if a.want_prices:
+           fetch_date = datetime.now().strftime("%Y-%m-%d")
+        batch_size = int(config.get('write_batch_size', 100))
+        if a.worker:
+            for kind, wanted, stocks in [('prices', a.want_prices, price_stocks), ('details', a.want_details, details_stocks)]:
+                if wanted:
+                    print("**** UPDATING {} AS WORKER".format(kind.upper()))
+                    with metrics.phase(kind):
+                        completed = run_worker(db, config, kind, fetch_date, stocks)
+                    if kind == 'prices' and completed:
+                        refresh_matrices(db, config, fetch_date)
+        elif a.want_prices:
             print("**** UPDATING PRICES")
-            if a.date:
-               import re
-               pattern = re.compile(r"^\d{4}-\d{2}-\d{2}$")
-               assert pattern.match(a.date)
-               fetch_date = a.date
-            else:
-               fetch_date = datetime.now().strftime("%Y-%m-%d")
-            update_prices(db, stocks_to_fetch, config, fetch_date, ensure_indexes=True)
-        if a.want_details:
+            journal = RunJournal.resume(db, 'prices', fetch_date, batch_size=batch_size) if a.resume else None
+            if journal is not None:
+               price_stocks = journal.pending_stocks()
+               print("Resuming run {}: {} stocks failed or untried".format(journal.run_id, len(price_stocks)))
+            with metrics.phase('prices'):
+                update_prices(db, price_stocks, config, fetch_date, ensure_indexes=True, journal=journal)
+            refresh_matrices(db, config, fetch_date)
+        if a.want_details and not a.worker:
             print("**** UPDATING COMPANY DETAILS")
-            update_company_details(db, stocks_to_fetch, config, ensure_indexes=True)
+            journal = RunJournal.resume(db, 'details', fetch_date, batch_size=batch_size) if a.resume else None
+            if journal is not None:
+               details_stocks = journal.pending_stocks()
+               print("Resuming run {}: {} stocks failed or untried".format(journal.run_id, len(details_stocks)))
+            with metrics.phase('details'):
+                update_company_details(db, details_stocks, config, ensure_indexes=True, journal=journal, fetch_date=fetch_date)
 
-    if a.validate:
-        validate_prices("test.tsv")
+    if a.validate or a.export_expectations:
+        validate_date = a.date if a.date else datetime.now().strftime("%Y-%m-%d")
+        fname = "{}/asx_prices/prices.{}.tsv".format(config.get('data_root'), validate_date)
+        if a.validate:
+            validate_prices(fname, db=db, fetch_date=validate_date, max_jump=float(config.get('max_price_jump', 0.5)))
+        if a.export_expectations:
+            export_expectations(fname)
 
+    if len(metrics.phase_seconds) > 0:
+        summary = metrics.summary()
+        db.ingest_metrics.insert_one({ 'started': started, 'finished': datetime.utcnow(), 'argv': sys.argv[1:],
+                                       'host': socket.gethostname(), 'metrics': summary })
+        with open("{}/asxtrade.json".format(config.get('data_root')), 'w') as fp:
+            json.dump(summary, fp, indent=3)
+        metrics.write_prometheus(config.get('metrics_file', "{}/asxtrade.prom".format(config.get('data_root'))))
     mongo.close()
     print("Run completed.")
     exit(0)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""
+Benchmark the parquet codecs (and float32 storage) available to persist_dataframes.py on real-sized matrices, so that
+set_matrix_encoding() can be chosen on the basis of data rather than folklore. Reports the size of each encoded matrix and the
+median time to encode and decode it (decoding is what the viewer pays on every page). By default synthetic matrices of a
+month of the whole market are used; --mongo-host benchmarks the matrices already saved in market_quote_cache eg.
+
+    python3 bench_codecs.py --stocks 2200 --days 22 --repeat 5
+    python3 bench_codecs.py --mongo-host pi1 --month 7 --year 2020
+"""
+import argparse
+import io
+import time
+import numpy as np
+import pandas as pd
+import persist_dataframes
+
+def synthetic_matrices(n_stocks, n_days, seed=42):
+    """
+    Return a dict of field -> matrix (stocks X dates) shaped and valued like the monthly matrices for the ASX:
+    prices span several orders of magnitude, percentages have two decimal places, volume is often zero and a few
+    percent of values are missing
+    """
+    rng = np.random.default_rng(seed)
+    codes = sorted(set(["".join(rng.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"), 3)) for i in range(n_stocks * 2)]))[0:n_stocks]
+    dates = [str(d.date()) for d in pd.bdate_range("2020-07-01", periods=n_days)]
+    base = np.round(np.exp(rng.uniform(np.log(0.005), np.log(100.0), (len(codes), 1))), 3)
+    walk = np.cumprod(1.0 + rng.normal(0.0, 0.02, (len(codes), n_days)), axis=1)
+    last = np.round(base * walk, 3)
+    change = np.round(np.diff(np.hstack([base, last]), axis=1), 3)
+    matrices = { 'last_price': last, 'change_price': change,
+                 'change_in_percent': np.round(change / (last - change) * 100.0, 2),
+                 'day_low_price': np.round(last * 0.98, 3), 'day_high_price': np.round(last * 1.02, 3),
+                 'volume': np.where(rng.random((len(codes), n_days)) < 0.15, 0, rng.integers(1000, 50000000, (len(codes), n_days))).astype(float),
+                 'eps': np.repeat(np.round(rng.uniform(-0.1, 2.0, (len(codes), 1)), 4), n_days, axis=1),
+                 'pe': np.repeat(np.round(rng.uniform(0.0, 40.0, (len(codes), 1)), 2), n_days, axis=1),
+                 'annual_dividend_yield': np.repeat(np.round(rng.uniform(0.0, 8.0, (len(codes), 1)), 2), n_days, axis=1) }
+    ret = {}
+    for field_name, values in matrices.items():
+        values = np.where(rng.random(values.shape) < 0.03, np.nan, values)
+        df = pd.DataFrame(values, index=pd.Index(codes, name='asx_code'), columns=pd.Index(dates, name='fetch_date'))
+        ret[field_name] = df
+    return ret
+
+def saved_matrices(db, month, year):
+    return { field_name: df for field_name, df in [(field_name, persist_dataframes.load_matrix(db, field_name, month, year))
+                                                   for field_name in persist_dataframes.all_fields] if df is not None and len(df) > 0 }
+
+def encode(df, codec, **kwargs):
+    with io.BytesIO() as fp:
+        df.to_parquet(fp, compression=codec if codec != 'none' else None, index=True, **kwargs)
+        return fp.getvalue()
+
+def timed(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, np.median(times)
+
+def bench(matrices, codec, float32, repeat):
+    """
+    Return (total encoded bytes, encode seconds, decode seconds) for the matrices, plus their wide equivalent
+    """
+    persist_dataframes.set_matrix_encoding(codec, float32)
+    narrow = [persist_dataframes.narrow_dtypes(df, { col: field_name for col in df.columns }) for field_name, df in matrices.items()]
+    wide = pd.concat([df.rename(columns=lambda d: "{}:{}".format(field_name, d)) for field_name, df in matrices.items()], axis=1)
+    wide = persist_dataframes.narrow_dtypes(wide, { col: col.split(':')[0] for col in wide.columns })
+    results = []
+    for frames, row_group_size in [(narrow, None), ([wide], persist_dataframes.wide_row_group_size)]:
+        kwargs = { 'row_group_size': row_group_size } if row_group_size is not None else {}
+        blobs, encode_time = timed(lambda: [encode(df, codec, **kwargs) for df in frames], repeat)
+        frames_read, decode_time = timed(lambda: [persist_dataframes.widen_dtypes(pd.read_parquet(io.BytesIO(b))) for b in blobs], repeat)
+        results.append((sum([len(b) for b in blobs]), encode_time, decode_time))
+    return results
+
+if __name__ == "__main__":
+    a = argparse.ArgumentParser(description="Benchmark parquet codecs for the matrices saved by persist_dataframes.py")
+    a.add_argument("--stocks", help="Number of stocks in synthetic matrices [2200]", type=int, default=2200)
+    a.add_argument("--days", help="Number of trading days in synthetic matrices [22]", type=int, default=22)
+    a.add_argument("--repeat", help="Take the median of this many encodes/decodes [5]", type=int, default=5)
+    a.add_argument("--codecs", help="Comma separated codecs to try [{}]".format(",".join(persist_dataframes.codecs)),
+                   type=str, default=",".join(persist_dataframes.codecs))
+    a.add_argument("--mongo-host", help="Benchmark the matrices saved in market_quote_cache on this mongo server", type=str, required=False)
+    a.add_argument("--mongo-port", help="TCP port for --mongo-host [27017]", type=int, default=27017)
+    a.add_argument("--mongo-db", help="Database name for --mongo-host [asxtrade]", type=str, default="asxtrade")
+    a.add_argument("--dbuser", help="MongoDB username for --mongo-host", type=str, required=False)
+    a.add_argument("--dbpassword", help="MongoDB password for --dbuser", type=str, required=False)
+    a.add_argument("--month", help="Month of matrices to use with --mongo-host", type=int, default=7)
+    a.add_argument("--year", help="Year of matrices to use with --mongo-host", type=int, default=2020)
+    args = a.parse_args()
+
+    if args.mongo_host:
+        import pymongo
+        mongo = pymongo.MongoClient(args.mongo_host, args.mongo_port, username=args.dbuser, password=args.dbpassword)
+        matrices = saved_matrices(mongo[args.mongo_db], args.month, args.year)
+        assert len(matrices) > 0 # no matrices for the month?
+    else:
+        matrices = synthetic_matrices(args.stocks, args.days)
+    shape = next(iter(matrices.values())).shape
+    print("Benchmarking {} matrices of {} stocks X {} days (median of {} runs)".format(len(matrices), shape[0], shape[1], args.repeat))
+    print("")
+    print("{:<8} {:<8} {:<7} {:>10} {:>12} {:>12}".format("codec", "dtype", "layout", "size (KB)", "encode (ms)", "decode (ms)"))
+    for codec in args.codecs.split(','):
+        for float32 in [False, True]:
+            narrow, wide = bench(matrices, codec, float32, args.repeat)
+            for layout, (size, encode_time, decode_time) in [('narrow', narrow), ('wide', wide)]:
+                print("{:<8} {:<8} {:<7} {:>10.1f} {:>12.1f} {:>12.1f}".format(codec, "float32" if float32 else "float64", layout,
+                      size / 1024.0, encode_time * 1000.0, decode_time * 1000.0))
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+"""
+Micro-benchmark of the fixed-format date parsing in asxtrade.py, and of the viewer's parse_fetch_date(), versus the
+general purpose parsers they replace. Reports the time taken to parse 10k dates of each kind eg. python3 bench_dates.py --n 10000
+"""
+import argparse
+import os
+import sys
+import timeit
+import dateutil.parser
+from datetime import datetime, date, timedelta
+from random import randint
+from asxtrade import parse_asx_datetime
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer'))
+from app.dates import parse_fetch_date
+
+def random_dates(n, fmt):
+    start = date(2018, 1, 1)
+    return [(start + timedelta(days=randint(0, 1000))).strftime(fmt) for i in range(n)]
+
+def report(label, fn, dates, repeat):
+    best = min(timeit.repeat(lambda: [fn(d) for d in dates], number=1, repeat=repeat))
+    print("{:<40} {:>10.2f} ms per {} dates".format(label, best * 1000.0, len(dates)))
+    return best
+
+if __name__ == "__main__":
+    a = argparse.ArgumentParser(description="Benchmark date parsing for ASX quote payloads and fetch_date strings")
+    a.add_argument("--n", help="Number of dates to parse per run [10000]", type=int, default=10000)
+    a.add_argument("--repeat", help="Number of runs (best is reported) [5]", type=int, default=5)
+    args = a.parse_args()
+
+    # eg. last_trade_date in a quote, with AEST or AEDT offset
+    quote_dates = [d + ("+1000" if randint(0, 1) else "+1100") for d in random_dates(args.n, "%Y-%m-%dT00:00:00")]
+    assert all([parse_asx_datetime(d) == dateutil.parser.parse(d) for d in quote_dates[:100]])
+    slow = report("dateutil.parser.parse (quote dates)", dateutil.parser.parse, quote_dates, args.repeat)
+    fast = report("parse_asx_datetime (quote dates)", parse_asx_datetime, quote_dates, args.repeat)
+    print("Speed-up: {:.1f}x".format(slow / fast))
+
+    # eg. fetch_date as used by the viewer
+    fetch_dates = random_dates(args.n, "%Y-%m-%d")
+    assert all([parse_fetch_date(d) == parse_asx_datetime(d) == datetime.strptime(d, "%Y-%m-%d") for d in fetch_dates[:100]])
+    slow = report("datetime.strptime (fetch dates)", lambda d: datetime.strptime(d, "%Y-%m-%d"), fetch_dates, args.repeat)
+    report("datetime.fromisoformat (fetch dates)", datetime.fromisoformat, fetch_dates, args.repeat)
+    fast = report("viewer parse_fetch_date (fetch dates)", parse_fetch_date, fetch_dates, args.repeat)
+    print("Speed-up: {:.1f}x".format(slow / fast))
+    fast = report("parse_asx_datetime (fetch dates)", parse_asx_datetime, fetch_dates, args.repeat)
+    print("Speed-up: {:.1f}x".format(slow / fast))
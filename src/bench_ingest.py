@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+"""
+Benchmark the asxtrade.py ingesters against a local fake_asx_server.py, so that concurrency and batching changes can
+be measured without touching asx.com.au. Mongo is mocked (mongomock) unless --mongo-host is given, in which case the
+named database on that server is used and SHOULD NOT be the production one. Reports stocks/sec, p50/p99 request
+latency and Mongo write time for each phase eg.
+
+    python3 bench_ingest.py --universe 500 --latency 0.1 --rate-404 0.02 --workers 8 --rps 50
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import asxtrade
+from fake_asx_server import serve, make_config, add_fake_asx_arguments, fake_asx_from_args
+
+class TimedCollection:
+    """
+    Proxy for a Mongo collection which accumulates the time spent in write operations
+    """
+    write_methods = set(['bulk_write', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+                         'delete_one', 'delete_many', 'find_one_and_update', 'find_one_and_replace'])
+
+    def __init__(self, collection, stats):
+        self.collection = collection
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not name in self.write_methods:
+            return attr
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.stats.add_write(time.monotonic() - start)
+        return timed
+
+class TimedDatabase:
+    def __init__(self, db, stats):
+        self.db = db
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return TimedCollection(getattr(self.db, name), self.stats)
+
+    def __getitem__(self, name):
+        return TimedCollection(self.db[name], self.stats)
+
+class PhaseStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.n_writes = 0
+        self.write_time = 0.0
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def add_write(self, seconds):
+        with self.lock:
+            self.n_writes += 1
+            self.write_time += seconds
+
+    def reset(self):
+        """
+        Return the stats collected so far as a new PhaseStats and start again from zero
+        """
+        snapshot = PhaseStats()
+        with self.lock:
+            snapshot.latencies, snapshot.n_writes, snapshot.write_time = self.latencies, self.n_writes, self.write_time
+            self.latencies = []
+            self.n_writes = 0
+            self.write_time = 0.0
+        return snapshot
+
+def instrument_fetcher(stats):
+    """
+    Wrap asxtrade.get_fetcher() so every session records the latency of each response
+    """
+    get_fetcher = asxtrade.get_fetcher
+    def timed_fetcher():
+        fetcher = get_fetcher()
+        fetcher.hooks['response'].append(lambda resp, *args, **kwargs: stats.add_latency(resp.elapsed.total_seconds()))
+        return fetcher
+    asxtrade.get_fetcher = timed_fetcher
+
+def report(phase, n_stocks, elapsed, stats):
+    latencies = np.array(stats.latencies) if len(stats.latencies) > 0 else np.array([np.nan])
+    print("{:<10} {:>7} {:>10.1f} {:>12.1f} {:>9} {:>9.1f} {:>9.1f} {:>8} {:>10.3f}".format(phase, n_stocks, elapsed,
+          n_stocks / elapsed if elapsed > 0 else 0.0, len(stats.latencies),
+          np.percentile(latencies, 50) * 1000.0, np.percentile(latencies, 99) * 1000.0,
+          stats.n_writes, stats.write_time))
+
+if __name__ == "__main__":
+    a = argparse.ArgumentParser(description="Benchmark asxtrade.py ingestion against a local fake ASX server")
+    add_fake_asx_arguments(a)
+    a.add_argument("--workers", help="Concurrent fetcher threads [4]", type=int, default=4)
+    a.add_argument("--rps", help="Global requests per second budget [50]", type=float, default=50.0)
+    a.add_argument("--batch-size", help="Mongo bulk write batch size [100]", type=int, default=100)
+    a.add_argument("--phases", help="Comma separated phases to run [isin,companies,prices,details]", type=str, default="isin,companies,prices,details")
+    a.add_argument("--mongo-host", help="Benchmark against a real mongo server rather than mongomock", type=str, required=False)
+    a.add_argument("--mongo-port", help="TCP port for --mongo-host [27017]", type=int, default=27017)
+    a.add_argument("--mongo-db", help="Database name for --mongo-host (will be written to!) [asxtrade_bench]", type=str, default="asxtrade_bench")
+    args = a.parse_args()
+
+    if args.mongo_host:
+        import pymongo
+        mongo = pymongo.MongoClient(args.mongo_host, args.mongo_port)
+    else:
+        import mongomock
+        mongo = mongomock.MongoClient()
+    stats = PhaseStats()
+    db = TimedDatabase(mongo[args.mongo_db], stats)
+    instrument_fetcher(stats)
+
+    fake = fake_asx_from_args(args)
+    server = serve(fake)
+    data_root = tempfile.mkdtemp(prefix="bench_ingest")
+    for subdir in ['asx_prices', 'asx_isin']:
+        os.makedirs(os.path.join(data_root, subdir))
+    config = make_config(server)
+    config.update({ 'data_root': data_root, 'fetch_workers': args.workers, 'requests_per_second': args.rps,
+                    'write_batch_size': args.batch_size })
+    print("Fake ASX serving {} securities at {}".format(len(fake.codes), config.get('asx_prices')))
+    fetch_date = datetime.now().strftime("%Y-%m-%d")
+
+    results = []
+    for phase in args.phases.split(','):
+        start = time.monotonic()
+        if phase == 'isin':
+            asxtrade.update_isin(db, config)
+            n_stocks = len(fake.codes)
+        elif phase == 'companies':
+            asxtrade.update_companies(db, config)
+            n_stocks = len(fake.codes)
+        elif phase == 'prices':
+            stocks = asxtrade.available_stocks(db, config) if 'isin' in args.phases else fake.codes
+            asxtrade.update_prices(db, stocks, config, fetch_date)
+            n_stocks = len(stocks)
+        elif phase == 'details':
+            stocks = asxtrade.available_stocks(db, config) if 'isin' in args.phases else fake.codes
+            asxtrade.update_company_details(db, stocks, config)
+            n_stocks = len(stocks)
+        else:
+            raise ValueError("Unknown phase: {}".format(phase))
+        results.append((phase, n_stocks, time.monotonic() - start, stats.reset()))
+
+    print("")
+    print("{:<10} {:>7} {:>10} {:>12} {:>9} {:>9} {:>9} {:>8} {:>10}".format("phase", "stocks", "wall (s)", "stocks/sec",
+          "requests", "p50 (ms)", "p99 (ms)", "writes", "write (s)"))
+    for phase, n_stocks, elapsed, phase_stats in results:
+        report(phase, n_stocks, elapsed, phase_stats)
+    print("Fake ASX served {} requests; data saved to {}".format(fake.n_requests, data_root))
+    server.shutdown()
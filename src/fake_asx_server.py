@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+"""
+Stand-in for the ASX endpoints used by asxtrade.py, serving synthetic (but realistically shaped) payloads so
+that the ingesters can be exercised and benchmarked offline. Latency, universe size and the rate of 404, 429 and 5xx
+responses are configurable. Run standalone eg. python3 fake_asx_server.py --port 8765 --universe 2000 and point
+config.json at http://127.0.0.1:8765 or use bench_ingest.py which starts one automatically.
+"""
+import argparse
+import json
+import random
+import string
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+class FakeASX:
+    """
+    Synthetic universe of securities plus the error/latency model. Payloads for a given code are stable across
+    requests (seeded by code) apart from the price moving a little each time it is fetched.
+    """
+    def __init__(self, universe=2000, latency=0.05, jitter=0.5, rate_404=0.01, rate_429=0.0, rate_5xx=0.0, seed=42):
+        assert universe > 0
+        assert latency >= 0.0
+        assert all([rate >= 0.0 and rate < 1.0 for rate in [rate_404, rate_429, rate_5xx]])
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_404 = rate_404
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        codes = set()
+        while len(codes) < universe:
+            codes.add(''.join(self.random.choice(string.ascii_uppercase) for i in range(3)))
+        self.codes = sorted(codes)
+        self.sectors = ['Materials', 'Banks', 'Energy', 'Health Care Equipment & Services', 'Software & Services',
+                        'Real Estate', 'Capital Goods, Transportation', 'Not Applic']
+        self.n_requests = 0
+
+    def uniform(self):
+        with self.lock:
+            return self.random.random()
+
+    def delay(self):
+        if self.latency > 0.0:
+            jitter = self.latency * self.jitter
+            time.sleep(max(0.0, self.latency + (self.uniform() * 2.0 - 1.0) * jitter))
+
+    def failure(self):
+        """
+        Return the HTTP status to fail the current request with, or None if it should succeed
+        """
+        p = self.uniform()
+        if p < self.rate_429:
+            return 429
+        if p < self.rate_429 + self.rate_5xx:
+            return 503
+        return None
+
+    def security_name(self, i):
+        if i % 20 == 19:
+            return "OPTION EXPIRING 18-AUG-2022 RESTRICTED"
+        if i % 10 == 9:
+            return "EXCHANGE TRADED FUND UNITS FULLY PAID"
+        return "ORDINARY FULLY PAID"
+
+    def company_name(self, asx_code):
+        return "{} {} LIMITED".format(asx_code, "HOLDINGS" if ord(asx_code[0]) % 2 else "RESOURCES")
+
+    def isin_payload(self):
+        # NB: update_isin() skips the first four rows after the header, just like the real thing
+        lines = ["ASX code\tCompany name\tSecurity type\tISIN code"]
+        lines.extend(["\t\t\t"] * 4)
+        for i, asx_code in enumerate(self.codes):
+            lines.append("{}\t{}\t{}\tAU0000{}{}".format(asx_code, self.company_name(asx_code), self.security_name(i), asx_code, i % 10))
+        return "\n".join(lines).encode()
+
+    def companies_payload(self):
+        lines = ["ASX listed companies as at {}".format(datetime.now().strftime("%a %b %d %H:%M:%S AEST %Y")), "",
+                 'Company name,ASX code,GICS industry group']
+        for asx_code in self.codes:
+            sector = self.sectors[sum(map(ord, asx_code)) % len(self.sectors)]
+            lines.append('"{}","{}","{}"'.format(self.company_name(asx_code), asx_code, sector))
+        return "\n".join(lines).encode()
+
+    def quote(self, asx_code):
+        r = random.Random(asx_code)
+        price = round(r.uniform(0.005, 100.0), 3)
+        change = round(price * (self.uniform() - 0.5) * 0.1, 3)
+        volume = 0 if r.random() < 0.1 else r.randint(1000, 50000000) # some stocks are dormant
+        today = datetime.now().strftime("%Y-%m-%dT00:00:00+1000")
+        return { "code": asx_code, "isin_code": "AU0000{}0".format(asx_code), "desc_full": "Ordinary Fully Paid",
+                 "last_price": price, "open_price": price, "day_high_price": round(price * 1.02, 3),
+                 "day_low_price": round(price * 0.98, 3), "change_price": change,
+                 "change_in_percent": "{:.3f}%".format(change / price * 100.0), "volume": volume,
+                 "bid_price": price, "offer_price": round(price * 1.01, 3), "previous_close_price": round(price - change, 3),
+                 "previous_day_percentage_change": "{:.3f}%".format(r.uniform(-5.0, 5.0)),
+                 "year_high_price": round(price * 1.5, 3), "last_trade_date": today,
+                 "year_high_date": (datetime.now() - timedelta(days=r.randint(1, 300))).strftime("%Y-%m-%dT00:00:00+1000"),
+                 "year_low_price": round(price * 0.5, 3),
+                 "year_low_date": (datetime.now() - timedelta(days=r.randint(1, 300))).strftime("%Y-%m-%dT00:00:00+1100"),
+                 "pe": round(r.uniform(0.0, 40.0), 2), "eps": round(r.uniform(-0.1, 2.0), 4),
+                 "average_daily_volume": r.randint(1000, 10000000), "annual_dividend_yield": round(r.uniform(0.0, 8.0), 2),
+                 "market_cap": r.randint(1000000, 100000000000), "number_of_shares": r.randint(1000000, 5000000000),
+                 "deprecated_market_cap": r.randint(1000000, 100000000000),
+                 "deprecated_number_of_shares": r.randint(1000000, 5000000000), "suspended": False }
+
+    def company_details(self, asx_code):
+        r = random.Random(asx_code)
+        return { "code": asx_code, "name_full": self.company_name(asx_code), "name_short": asx_code,
+                 "delisting_date": None, "listing_date": "2018-08-20T00:00:00+1000", "phone_number": "02 9300 3311",
+                 "principal_activities": "Synthetic company {} for benchmarking.".format(asx_code),
+                 "sector_name": self.sectors[sum(map(ord, asx_code)) % len(self.sectors)],
+                 "web_address": "http://www.example.com/{}".format(asx_code.lower()), "products": ["shares"],
+                 "recent_announcement": r.random() < 0.2, "primary_share_code": asx_code,
+                 "primary_share": self.quote(asx_code),
+                 "latest_annual_reports": [{ "id": "{:08d}".format(r.randint(0, 99999999)),
+                                             "document_release_date": "2020-04-29T14:45:12+1000",
+                                             "header": "Annual Report", "number_of_pages": r.randint(20, 200) }],
+                 "last_dividend": { "amount": round(r.uniform(0.0, 1.0), 3), "type": "FINAL" } }
+
+class FakeASXHandler(BaseHTTPRequestHandler):
+    fake = None  # set by serve()
+
+    def reply(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status in (429, 503):
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        fake = self.fake
+        fake.n_requests += 1
+        fake.delay()
+        path = urlparse(self.path).path
+        status = fake.failure()
+        if status is not None:
+            self.reply(status)
+        elif path.endswith('.csv'):
+            self.reply(200, fake.companies_payload(), 'text/csv')
+        elif path.endswith('.xls'):
+            self.reply(200, fake.isin_payload(), 'application/vnd.ms-excel')
+        elif path.startswith('/asx/1/share/') or path.startswith('/asx/1/company/'):
+            asx_code = path.rstrip('/').split('/')[-1]
+            if not asx_code in fake.codes or fake.uniform() < fake.rate_404:
+                self.reply(404, json.dumps({ "error_code": "id-or-code-invalid", "error_desc": "Invalid code" }).encode())
+            elif path.startswith('/asx/1/share/'):
+                self.reply(200, json.dumps(fake.quote(asx_code)).encode())
+            else:
+                self.reply(200, json.dumps(fake.company_details(asx_code)).encode())
+        else:
+            self.reply(404)
+
+    def log_message(self, format, *args):
+        pass # far too noisy for a benchmark
+
+def serve(fake, host='127.0.0.1', port=0):
+    """
+    Start serving fake in a background thread and return the server (server.server_address has the actual port)
+    """
+    handler = type('BoundFakeASXHandler', (FakeASXHandler,), { 'fake': fake })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def make_config(server):
+    """
+    Return the asxtrade.py config entries which point at the fake server
+    """
+    host, port = server.server_address[0:2]
+    base = "http://{}:{}".format(host, port)
+    return { "asx_companies": base + "/asx/research/ASXListedCompanies.csv",
+             "asx_isin": base + "/programs/ISIN.xls",
+             "asx_prices": base + "/asx/1/share/",
+             "asx_company_details": base + "/asx/1/company/%s?fields=primary_share,latest_annual_reports,last_dividend,primary_share.indices" }
+
+def add_fake_asx_arguments(a):
+    a.add_argument("--universe", help="Number of securities [2000]", type=int, default=2000)
+    a.add_argument("--latency", help="Mean response latency in seconds [0.05]", type=float, default=0.05)
+    a.add_argument("--rate-404", help="Fraction of requests for a security which fail with 404 [0.01]", type=float, default=0.01)
+    a.add_argument("--rate-429", help="Fraction of requests which fail with 429 [0.0]", type=float, default=0.0)
+    a.add_argument("--rate-5xx", help="Fraction of requests which fail with 503 [0.0]", type=float, default=0.0)
+    a.add_argument("--seed", help="Random seed for the universe [42]", type=int, default=42)
+
+def fake_asx_from_args(args):
+    return FakeASX(universe=args.universe, latency=args.latency, rate_404=args.rate_404,
+                   rate_429=args.rate_429, rate_5xx=args.rate_5xx, seed=args.seed)
+
+if __name__ == "__main__":
+    a = argparse.ArgumentParser(description="Serve synthetic ASX data for offline testing of asxtrade.py")
+    a.add_argument("--port", help="TCP port to listen on [8765]", type=int, default=8765)
+    add_fake_asx_arguments(a)
+    args = a.parse_args()
+    server = serve(fake_asx_from_args(args), port=args.port)
+    print(json.dumps(make_config(server), indent=3))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
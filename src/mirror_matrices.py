@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Mirror the matrices in market_quote_cache (see persist_dataframes.py) to a local directory as uncompressed Arrow IPC
+(Feather v2) files, so that the viewer can memory-map them rather than fetching and decoding parquet from mongo on each
+request: all gunicorn workers on the host then share one page-cached copy. Run after persist_dataframes.py eg.
+
+    python3 mirror_matrices.py --dbpassword '$PASSWORD' --dir /var/cache/asxtrade/market_quote_cache
+
+and set MARKET_DATA_MIRROR to the same directory for the viewer. Each file is named <tag>.<sha256>.arrow after the
+parquet it was made from (and verified against), so a matrix saved since the last sync is never read stale: the viewer
+just won't find a file for the new sha256 and falls back to mongo.
+"""
+import argparse
+import hashlib
+import io
+import os
+import pymongo
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from persist_dataframes import matrix_bucket
+
+def mirror_path(mirror_dir, tag, sha256):
+    return os.path.join(mirror_dir, "{}.{}.arrow".format(tag, sha256))
+
+def fetch_blob(db, rec):
+    """
+    Return the parquet bytes for the market_quote_cache document rec, from GridFS or the document itself
+    """
+    if rec.get('gridfs_id') is not None:
+        with matrix_bucket(db).open_download_stream(rec.get('gridfs_id')) as fp:
+            return fp.read()
+    return db.market_quote_cache.find_one({ '_id': rec.get('_id') }, { 'dataframe': 1 }).get('dataframe')
+
+def mirror_table(parquet_bytes):
+    """
+    Return the parquet as a single-chunk arrow table which pandas can use without copying: float columns are float64
+    (whatever persist_dataframes.set_matrix_encoding() saved) with NaN rather than nulls for missing values
+    """
+    table = pq.read_table(io.BytesIO(parquet_bytes))
+    columns = []
+    fields = []
+    for field, column in zip(table.schema, table.columns):
+        if pa.types.is_floating(field.type):
+            column = pc.fill_null(column.cast(pa.float64()), float('nan'))
+            field = field.with_type(pa.float64())
+        columns.append(column)
+        fields.append(field)
+    return pa.Table.from_arrays(columns, schema=pa.schema(fields, metadata=table.schema.metadata)).combine_chunks()
+
+def sync_mirror(db, mirror_dir, formats=('parquet', 'parquet-wide')):
+    """
+    Bring mirror_dir up to date with the matrices in market_quote_cache: new and changed matrices are written (only
+    if the parquet matches the sha256 recorded with it), old versions and matrices no longer in mongo are removed.
+    Returns a dict of counts of matrices by outcome.
+    """
+    os.makedirs(mirror_dir, exist_ok=True)
+    stats = { 'current': 0, 'written': 0, 'bad_checksum': 0, 'removed': 0 }
+    wanted = set()
+    for rec in db.market_quote_cache.find({ 'dataframe_format': { "$in": list(formats) } },
+                                          { 'tag': 1, 'sha256': 1, 'gridfs_id': 1 }):
+        tag, sha256 = rec.get('tag'), rec.get('sha256')
+        path = mirror_path(mirror_dir, tag, sha256)
+        wanted.add(os.path.basename(path))
+        if os.path.exists(path):
+            stats['current'] += 1
+            continue
+        parquet_bytes = fetch_blob(db, rec)
+        if parquet_bytes is None or hashlib.sha256(parquet_bytes).hexdigest() != sha256:
+            print("WARNING: {} does not match its sha256 - not mirrored".format(tag))
+            stats['bad_checksum'] += 1
+            continue
+        tmp_path = path + ".tmp"
+        feather.write_feather(mirror_table(parquet_bytes), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path) # NB: atomic, so the viewer never maps a partially written file
+        stats['written'] += 1
+    for fname in os.listdir(mirror_dir):
+        if fname.endswith(".arrow") and not fname in wanted:
+            os.remove(os.path.join(mirror_dir, fname))
+            stats['removed'] += 1
+    return stats
+
+if __name__ == "__main__":
+   a = argparse.ArgumentParser(description="Mirror market_quote_cache matrices to local Arrow files for the viewer to memory-map")
+   default_host = 'pi1'
+   default_port = 27017
+   default_db = 'asxtrade'
+   a.add_argument("--db", help="Mongo host/ip to read from [{}]".format(default_host), type=str, default=default_host)
+   a.add_argument("--port", help="TCP port to access mongo db [{}]".format(str(default_port)), type=int, default=default_port)
+   a.add_argument("--dbname", help="Name on mongo DB to access [{}]".format(default_db), type=str, default=default_db)
+   a.add_argument("--dbuser", help="MongoDB RBAC username to use (read access required) [rw]", type=str, default='rw')
+   a.add_argument("--dbpassword", help="MongoDB password for user", type=str, required=True)
+   a.add_argument("--dir", help="Local directory to mirror matrices to (MARKET_DATA_MIRROR for the viewer)", type=str, required=True)
+   args = a.parse_args()
+
+   pwd = str(args.dbpassword)
+   if pwd.startswith('$'):
+       pwd = os.getenv(args.dbpassword[1:])
+   db = pymongo.MongoClient(host=args.db, port=args.port, username=args.dbuser, password=pwd)[args.dbname]
+   stats = sync_mirror(db, args.dir)
+   print("Mirrored to {}: {} written, {} already current, {} removed, {} failed checksum".format(args.dir,
+         stats['written'], stats['current'], stats['removed'], stats['bad_checksum']))
+   exit(0 if stats['bad_checksum'] == 0 else 1)
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import pymongo
+import gridfs
 from bson.binary import Binary
 import argparse
 import io
@@ -7,9 +8,13 @@ import json
 import os
 import pandas as pd
 import numpy
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import calendar
 import hashlib
+import time
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 
 def dates_of_month(month, year):
     assert month >= 1 and month <= 12
@@ -31,6 +36,49 @@ def clean_value(value):
     value = value.replace(',', '')
     return float(value)
 
+def clean_values(series):
+    """
+    Vectorised clean_value() for a whole column: strings like '3.39%' or '1,234' are stripped and everything is
+    co-erced to float (or we die trying). Missing values are NaN.
+    """
+    is_str = series.map(type) == str
+    if not is_str.any():
+        return pd.to_numeric(series, errors='raise').astype(float)
+    cleaned = series.where(~is_str, series[is_str].str.rstrip('%').str.replace(',', '', regex=False))
+    return pd.to_numeric(cleaned, errors='raise').astype(float)
+
+cursor_slots = None # semaphore bounding the number of concurrent asx_prices queries, when building months in parallel
+
+all_fields = ['change_in_percent', 'last_price', 'change_price', 'day_low_price', 'day_high_price', 'volume', 'eps', 'pe', 'annual_dividend_yield']
+
+def load_month(db, fields, month, year, days=None):
+    """
+    Return the specified fields of every asx_prices document in the month (or just the specified days of it) as a
+    single (long) dataframe with asx_code, fetch_date and one cleaned (float) column per field, using one projected
+    query however many fields are wanted.
+    """
+    assert db is not None
+    assert len(fields) > 0
+    days_of_month = dates_of_month(month, year) if days is None else days
+    projection = dict([('_id', 0), ('asx_code', 1), ('fetch_date', 1)] + [(field, 1) for field in fields])
+    with cursor_slots if cursor_slots is not None else nullcontext():
+        cursor = db.asx_prices.find({ 'fetch_date': { "$in": days_of_month }, "$or": [{ field: { "$exists": True } } for field in fields] },
+                                    projection, batch_size=10000)
+        df = pd.DataFrame.from_records(list(cursor), columns=['asx_code', 'fetch_date'] + fields)
+    for field in fields:
+        df[field] = clean_values(df[field])
+    return df
+
+def pivot_prices(df, field_name):
+    """
+    Return the stock X dates matrix of field_name from the dataframe returned by load_month(). Only stocks and dates
+    with at least one value for the field are included, just as if the field had been queried on its own.
+    """
+    df = df[df[field_name].notnull()]
+    if len(df) == 0:
+        return pd.DataFrame(columns=['fetch_date', 'asx_code', field_name]) # return dummy dataframe if empty
+    return df.pivot(index='asx_code', columns='fetch_date', values=field_name)
+
 def load_prices(db, field_name, month, year):
     """
     Build a matrix of all available stocks with the given field_name eg. 'last_price'. This
@@ -38,25 +86,23 @@ def load_prices(db, field_name, month, year):
     All dates in the specified month are included in the dataframe.
     The dataframe is always organised as stock X dates (stocks are rows) with the values of the specified field as float values
     """
-    assert db is not None
     assert len(field_name) > 0
-    days_of_month = dates_of_month(month, year)
-    rows = [{ 'asx_code': row['asx_code'],
-              'fetch_date': row['fetch_date'],
-              field_name: clean_value(row[field_name])}
-              for row in db.asx_prices.find({ 'fetch_date': { "$in": days_of_month }, field_name: { "$exists": True } }, { 'asx_code': 1, field_name: 1, 'fetch_date': 1})]
-    if len(rows) == 0:
-        df = pd.DataFrame(columns=['fetch_date', 'asx_code', field_name]) # return dummy dataframe if empty
-        return df
-        # FALLTHRU
-    df = pd.DataFrame.from_records(rows)
-    df = df.pivot(index='asx_code', columns='fetch_date', values=field_name)
-    return df
+    return pivot_prices(load_month(db, [field_name], month, year), field_name)
 
 def load_all_prices(db, month, year, status='FINAL', market='asx', scope='all-downloaded'):
-    for field_name in ['change_in_percent', 'last_price', 'change_price', 'day_low_price', 'day_high_price', 'volume', 'eps', 'pe', 'annual_dividend_yield']:
+    """
+    Build and save the matrix of each field for the month, returning a list with the statistics of each (see save_matrix())
+    """
+    print("Loading {} fields for {}-{}".format(len(all_fields), month, year))
+    start = time.monotonic()
+    all_prices = load_month(db, all_fields, month, year)  # NB: one query for all fields, rather than one per field
+    load_seconds = time.monotonic() - start
+    stats = []
+    matrices = {}
+    for field_name in all_fields:
         print("Constructing matrix: {} {}-{}".format(field_name, month, year))
-        df = load_prices(db, field_name, month, year)
+        start = time.monotonic()
+        df = pivot_prices(all_prices, field_name)
         if df.isnull().values.any():
            dates_with_missing = set(df.columns[df.isnull().any()])
            today = datetime.strftime(datetime.today(), "%Y-%m-%d")
@@ -66,25 +112,280 @@ def load_all_prices(db, month, year, status='FINAL', market='asx', scope='all-do
               print("Rows with missing data: ", json.dumps(list(df[df[today].isnull()].index)))
               pass # FALLTHRU...
 
-        with io.BytesIO() as fp:
-             # NB: if this fails it may be because you are using fastparquet which doesnt (yet) support BytesIO. Use eg. pyarrow
-             df.to_parquet(fp, compression='gzip', index=True)
-             fp.seek(0)
-             bytes = fp.read()
-             tag = "{}-{:02d}-{}-{}".format(field_name, month, year, market)
-             db.market_quote_cache.update_one({ 'tag': tag, 'scope': scope}, { "$set": {
-                     'tag': tag, 'status': status,
-                     'last_updated': datetime.utcnow(),
-                     'field': field_name,
-                     'market': market,
-                     'scope': scope,
-                     'n_days': len(df.columns),
-                     'n_stocks': len(df),
-                     'dataframe_format': 'parquet',
-                     'size_in_bytes': len(bytes),
-                     'sha256': hashlib.sha256(bytes).hexdigest(),
-                     'dataframe': Binary(bytes), # NB: always parquet format
-                 }}, upsert=True)
+        stats.append(save_matrix(db, df, field_name, month, year, status, market, scope))
+        stats[-1].update({ 'load_seconds': load_seconds, 'build_seconds': time.monotonic() - start })
+        matrices[field_name] = df
+    stats.append(save_wide_matrix(db, matrices, month, year, status, market, scope))
+    return stats
+
+def matrix_tag(field_name, month, year, market='asx'):
+    return period_tag(field_name, "{:02d}".format(month), year, market)
+
+def period_tag(field_name, period, year, market='asx'):
+    """
+    Tag of the matrix for field_name over period of year: MM for a month, Q1..Q4 for a quarter or YR for the whole year
+    """
+    return "{}-{}-{}-{}".format(field_name, period, year, market)
+
+max_inline_bytes = 8 * 1024 * 1024 # larger blobs are stored in GridFS, well clear of mongo's 16MB document limit
+retired_gridfs_seconds = 300 # replaced GridFS files are kept this long, so readers already streaming them can finish
+
+codecs = ['gzip', 'snappy', 'zstd', 'lz4', 'none']
+float32_fields = set(all_fields).difference(['volume']) # prices and percentages: volume needs float64 precision
+matrix_encoding = { 'codec': 'gzip', 'float32': False } # see set_matrix_encoding()
+
+def set_matrix_encoding(codec='gzip', float32=False):
+    """
+    Set the parquet compression codec and whether float32_fields are stored as float32 for matrices saved from now on.
+    gzip is the smallest but slowest to decode, which matters since the viewer decodes several matrices per page.
+    Readers need not care: the codec is in the parquet itself and read_matrix() widens float32 back to float64.
+    """
+    assert codec in codecs
+    matrix_encoding.update({ 'codec': codec, 'float32': bool(float32) })
+
+def narrow_dtypes(df, fields):
+    """
+    Return df with the columns for fields (a dict of column -> field) in float32_fields cast to float32, if enabled
+    """
+    if not matrix_encoding.get('float32') or 'asx_code' in df.columns:  # NB: leave dummy empty matrices alone
+        return df
+    return df.astype({ col: 'float32' for col, field_name in fields.items() if field_name in float32_fields })
+
+def matrix_bucket(db):
+    return gridfs.GridFSBucket(db, bucket_name='market_quote_cache')
+
+def save_blob(db, df, tag, scope, metadata, **kwargs):
+    """
+    Encode df as parquet (kwargs are passed to to_parquet()) and upsert the market_quote_cache document for tag
+    with metadata. The parquet is stored inline in the document, or in GridFS (with the document referring to it
+    via gridfs_id) if larger than max_inline_bytes. Returns the size of the encoded matrix.
+    """
+    codec = matrix_encoding.get('codec')
+    with io.BytesIO() as fp:
+         # NB: if this fails it may be because you are using fastparquet which doesnt (yet) support BytesIO. Use eg. pyarrow
+         df.to_parquet(fp, compression=codec if codec != 'none' else None, index=True, **kwargs)
+         bytes = fp.getvalue()
+    sha256 = hashlib.sha256(bytes).hexdigest()
+    prior = db.market_quote_cache.find_one({ 'tag': tag, 'scope': scope }, { 'gridfs_id': 1, 'retired_gridfs_ids': 1 })
+    now = datetime.utcnow()
+    retired = prior.get('retired_gridfs_ids', []) if prior is not None else []
+    expired = [r for r in retired if r.get('retired') < now - timedelta(seconds=retired_gridfs_seconds)]
+    retired = [r for r in retired if not r in expired]
+    if prior is not None and prior.get('gridfs_id') is not None:
+        retired.append({ 'id': prior.get('gridfs_id'), 'retired': now })
+    fields = dict(metadata)
+    fields.update({ 'tag': tag, 'scope': scope, 'last_updated': now, 'size_in_bytes': len(bytes), 'sha256': sha256,
+                    'compression': codec, 'value_dtypes': sorted(set([str(dtype) for dtype in df.dtypes])),
+                    'retired_gridfs_ids': retired })
+    if len(bytes) > max_inline_bytes:
+        fields['gridfs_id'] = matrix_bucket(db).upload_from_stream(tag, bytes, metadata={ 'scope': scope, 'sha256': sha256 })
+        update = { "$set": fields, "$unset": { 'dataframe': "" } }
+    else:
+        fields['dataframe'] = Binary(bytes) # NB: always parquet format
+        update = { "$set": fields, "$unset": { 'gridfs_id': "" } }
+    db.market_quote_cache.update_one({ 'tag': tag, 'scope': scope }, update, upsert=True)
+    # NB: a reader may have fetched the document just before the update and still be streaming the previous GridFS file,
+    # so it is only retired here and deleted by a later save once retired_gridfs_seconds have passed
+    for r in expired:
+        try:
+            matrix_bucket(db).delete(r.get('id'))
+        except gridfs.errors.NoFile:
+            pass
+    return len(bytes)
+
+def read_matrix(db, rec, columns=None):
+    """
+    Return the dataframe saved by save_blob() in the market_quote_cache document rec, reading only the specified
+    columns if given. GridFS blobs are streamed, so only the parquet footer and wanted columns are downloaded.
+    """
+    if rec.get('gridfs_id') is not None:
+        with matrix_bucket(db).open_download_stream(rec.get('gridfs_id')) as fp:
+            df = pd.read_parquet(fp, columns=columns)
+    else:
+        df = pd.read_parquet(io.BytesIO(rec.get('dataframe')), columns=columns)
+    return widen_dtypes(df)
+
+def widen_dtypes(df):
+    """
+    Return df with any float32 columns (see set_matrix_encoding()) as float64, so callers see the same dtypes however it was saved
+    """
+    float32_cols = [col for col, dtype in df.dtypes.items() if dtype == 'float32']
+    if len(float32_cols) == 0:
+        return df
+    return df.astype({ col: 'float64' for col in float32_cols })
+
+# Matrices are saved sorted by asx_code in row groups of this many stocks, so the min/max statistics of each row group
+# let readers wanting a few stocks decode just the row groups containing them (see app.models.matrix_frames())
+matrix_row_group_size = 250
+wide_row_group_size = 500 # stocks per row group in wide matrices
+
+def save_matrix(db, df, field_name, month, year, status, market='asx', scope='all-downloaded', period=None):
+    """
+    Save df as the matrix of field_name for the month (or period, see period_tag()), returning its tag, shape and size
+    """
+    tag = matrix_tag(field_name, month, year, market) if period is None else period_tag(field_name, period, year, market)
+    df = narrow_dtypes(df.sort_index(), { col: field_name for col in df.columns })
+    size = save_blob(db, df, tag, scope, { 'status': status, 'field': field_name, 'market': market,
+                                           'period': period if period is not None else "{:02d}".format(month),
+                                           'n_days': len(df.columns), 'n_stocks': len(df), 'dataframe_format': 'parquet' },
+                     row_group_size=matrix_row_group_size)
+    return { 'tag': tag, 'n_stocks': len(df), 'n_days': len(df.columns), 'size_in_bytes': size }
+
+def save_wide_matrix(db, matrices, month, year, status, market='asx', scope='all-downloaded'):
+    """
+    Save the month's matrices (a dict of field name -> matrix) as a single wide parquet blob, tagged
+    all-MM-YYYY-market, with a "field:date" column for each field and date (stocks are rows). Readers project just
+    the columns they need (see app.models.wide_superdfs()) so a page needing several fields does one fetch and one
+    decode per month, rather than one per field. Returns the statistics as for save_matrix().
+    """
+    start = time.monotonic()
+    matrices = { field_name: df for field_name, df in matrices.items() if len(df) > 0 and not 'asx_code' in df.columns }
+    if len(matrices) == 0:
+        return { 'tag': matrix_tag('all', month, year, market), 'n_stocks': 0, 'n_days': 0, 'size_in_bytes': 0,
+                 'load_seconds': 0.0, 'build_seconds': 0.0 }
+    wide = pd.concat([df.rename(columns=lambda d: "{}:{}".format(field_name, d)) for field_name, df in matrices.items()], axis=1).sort_index()
+    wide.index.name = 'asx_code'
+    wide = narrow_dtypes(wide, { col: col.split(':')[0] for col in wide.columns })
+    tag = matrix_tag('all', month, year, market)
+    n_days = len(set([c.split(':')[1] for c in wide.columns]))
+    size = save_blob(db, wide, tag, scope, { 'status': status, 'field': 'all', 'fields': sorted(matrices.keys()), 'market': market,
+                                             'period': "{:02d}".format(month), 'n_days': n_days, 'n_stocks': len(wide),
+                                             'dataframe_format': 'parquet-wide' },
+                     row_group_size=wide_row_group_size)
+    print("Saved wide matrix: {} ({} columns, {} stocks)".format(tag, len(wide.columns), len(wide)))
+    return { 'tag': tag, 'n_stocks': len(wide), 'n_days': n_days, 'size_in_bytes': size,
+             'load_seconds': 0.0, 'build_seconds': time.monotonic() - start }
+
+def load_matrix(db, field_name, month, year, market='asx', scope='all-downloaded'):
+    """
+    Return the saved matrix for field_name in the month, an empty dataframe if the field had no data when it was
+    saved or None if there is no saved matrix
+    """
+    rec = db.market_quote_cache.find_one({ 'tag': matrix_tag(field_name, month, year, market), 'scope': scope })
+    if rec is None:
+        return None
+    df = read_matrix(db, rec)
+    if len(df) == 0 or 'asx_code' in df.columns:  # dummy empty matrix?
+        return pd.DataFrame(index=pd.Index([], name='asx_code'))
+    return df
+
+period_months = { 'Q1': [1, 2, 3], 'Q2': [4, 5, 6], 'Q3': [7, 8, 9], 'Q4': [10, 11, 12], 'YR': list(range(1, 13)) }
+
+def load_period_prices(db, period, year, status='FINAL', market='asx', scope='all-downloaded'):
+    """
+    Build and save the matrix of each field over a quarter (Q1..Q4) or the whole year (YR), so that readers wanting
+    a long span of dates fetch one (GridFS-backed if need be) matrix rather than merging a dozen monthly ones
+    """
+    assert period in period_months
+    days = [d for month in period_months[period] for d in dates_of_month(month, year)]
+    print("Loading {} fields for {}-{}".format(len(all_fields), period, year))
+    start = time.monotonic()
+    all_prices = load_month(db, all_fields, None, year, days=days)
+    load_seconds = time.monotonic() - start
+    stats = []
+    for field_name in all_fields:
+        print("Constructing matrix: {} {}-{}".format(field_name, period, year))
+        start = time.monotonic()
+        df = pivot_prices(all_prices, field_name)
+        stats.append(save_matrix(db, df, field_name, None, year, status, market, scope, period=period))
+        stats[-1].update({ 'load_seconds': load_seconds, 'build_seconds': time.monotonic() - start })
+    return stats
+
+def refresh_prices(db, month, year, status='INCOMPLETE', market='asx', scope='all-downloaded'):
+    """
+    Incrementally update the month's matrices: load each from market_quote_cache and replace the columns for its newest
+    day onwards (so that stocks topped up since the last refresh are included) with one query of asx_prices for those
+    days. Much cheaper than load_all_prices() for a single new day. Fields without a saved matrix are built in full.
+    """
+    existing = { field_name: load_matrix(db, field_name, month, year, market, scope) for field_name in all_fields }
+    if all([df is None for df in existing.values()]):
+        print("No matrices for {}-{}: building in full".format(month, year))
+        return load_all_prices(db, month, year, status, market, scope)
+    newest = { field_name: max(df.columns) if df is not None and len(df.columns) > 0 else '' for field_name, df in existing.items() }
+    since = min([d for d in newest.values() if len(d) > 0], default='')
+    days = [d for d in dates_of_month(month, year) if d >= since or any([df is None for df in existing.values()])]
+    print("Refreshing {} matrices for {}-{} from {}".format(len(all_fields), month, year, days[0]))
+    start = time.monotonic()
+    recent_prices = load_month(db, all_fields, month, year, days=days)
+    load_seconds = time.monotonic() - start
+    stats = []
+    matrices = {}
+    for field_name in all_fields:
+        start = time.monotonic()
+        df = existing.get(field_name)
+        recent = pivot_prices(recent_prices, field_name)
+        if df is not None:
+            if 'asx_code' in recent.columns:  # dummy empty matrix ie. no new data
+                recent = pd.DataFrame(index=pd.Index([], name='asx_code'))
+            if len(recent.columns) == 0 and len(df.columns) == 0:
+                continue  # still no data for the field
+            keep = df[[d for d in df.columns if d < newest.get(field_name)]]
+            recent = recent[[d for d in recent.columns if d >= newest.get(field_name)]]
+            df = pd.concat([keep, recent], axis=1).sort_index()
+            df = df.dropna(how='all')
+            df.index.name = 'asx_code'
+            df.columns.name = 'fetch_date'
+            df = df[sorted(df.columns[df.notnull().any()])]  # same stocks and days as pivot_prices() would give
+        else:
+            df = recent
+        print("Refreshed matrix: {} {}-{} ({} days, {} stocks)".format(field_name, month, year, len(df.columns), len(df)))
+        stats.append(save_matrix(db, df, field_name, month, year, status, market, scope))
+        stats[-1].update({ 'load_seconds': load_seconds, 'build_seconds': time.monotonic() - start })
+        matrices[field_name] = df
+    stats.append(save_wide_matrix(db, matrices, month, year, status, market, scope))
+    return stats
+
+def months_between(from_month, to_month):
+    """
+    Return the (month, year) tuples from from_month to to_month inclusive, each specified as YYYY-MM
+    """
+    start = datetime.strptime(from_month, "%Y-%m")
+    end = datetime.strptime(to_month, "%Y-%m")
+    assert start <= end
+    return [((i % 12) + 1, i // 12) for i in range(start.year * 12 + start.month - 1, end.year * 12 + end.month)]
+
+pool_db = None # database connection of each process in the pool used by build_months()
+
+def init_pool_process(mongo_args, dbname, slots, encoding):
+    global pool_db, cursor_slots
+    pool_db = pymongo.MongoClient(**mongo_args)[dbname]  # NB: MongoClient is not fork-safe, so each process makes its own
+    cursor_slots = slots
+    set_matrix_encoding(**encoding)
+
+def build_month(month, year, status, incremental):
+    if incremental:
+        return refresh_prices(pool_db, month, year, status)
+    return load_all_prices(pool_db, month, year, status)
+
+def build_months(mongo_args, dbname, months, status, incremental=False, n_workers=4, max_cursors=2):
+    """
+    Build (or refresh) the matrices for each (month, year) using a pool of n_workers processes, with at most
+    max_cursors concurrent queries of asx_prices so that mongo isn't swamped. Returns the statistics of each matrix built.
+    """
+    assert n_workers >= 1
+    assert max_cursors >= 1
+    slots = multiprocessing.BoundedSemaphore(max_cursors)
+    stats = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_pool_process, initargs=(mongo_args, dbname, slots, dict(matrix_encoding))) as pool:
+        futures = { pool.submit(build_month, month, year, status, incremental): (month, year) for month, year in months }
+        for f in as_completed(futures):
+            month, year = futures[f]
+            try:
+                stats.extend(f.result())
+            except Exception as e:
+                print("ERROR: unable to build matrices for {}-{}: {}".format(month, year, str(e)))
+                stats.append({ 'tag': "*-{:02d}-{}".format(month, year), 'error': str(e) })
+    return stats
+
+def print_summary(stats):
+    print("{:<36} {:>7} {:>5} {:>10} {:>9} {:>10}".format("matrix", "stocks", "days", "size (KB)", "load (s)", "build (s)"))
+    for s in sorted(stats, key=lambda s: s.get('tag')):
+        if 'error' in s:
+            print("{:<36} FAILED: {}".format(s.get('tag'), s.get('error')))
+            continue
+        print("{:<36} {:>7} {:>5} {:>10.1f} {:>9.2f} {:>10.2f}".format(s.get('tag'), s.get('n_stocks'), s.get('n_days'),
+              s.get('size_in_bytes') / 1024.0, s.get('load_seconds'), s.get('build_seconds')))
+    print("{} matrices, {:.1f} MB in total".format(len(stats), sum([s.get('size_in_bytes', 0) for s in stats]) / (1024.0 * 1024.0)))
 
 if __name__ == "__main__":
    a = argparse.ArgumentParser(description="Construct and ingest db.asx_prices into parquet format month-by-month and persist to mongo")
@@ -111,17 +412,39 @@ if __name__ == "__main__":
        dict_args.update({ 'default': default_user })
    a.add_argument("--dbuser", **dict_args)
    a.add_argument("--dbpassword", help="MongoDB password for user", type=str, required=True)
-   a.add_argument("--month", help="Month of year 1..12", required=True, type=int)
+   a.add_argument("--month", help="Month of year 1..12", required=False, type=int)
    a.add_argument("--year", help="Year to load [2020]", default=2020, type=int)
+   a.add_argument("--from", help="First month to build [YYYY-MM], instead of --month/--year", dest='from_month', required=False, type=str)
+   a.add_argument("--to", help="Last month to build [YYYY-MM], defaults to --from", dest='to_month', required=False, type=str)
+   a.add_argument("--workers", help="Number of processes building months in parallel [4]", default=4, type=int)
+   a.add_argument("--max-cursors", help="Maximum number of concurrent queries of asx_prices [2]", default=2, type=int)
    a.add_argument("--status", help="Status of matrix eg. INCOMPLETE or FINAL", required=True, type=str)
+   a.add_argument("--period", help="Build quarterly (Q1..Q4) or whole year (YR) matrices for --year, instead of --month", required=False, type=str)
+   a.add_argument("--codec", help="Parquet compression for saved matrices: {} [gzip]".format(", ".join(codecs)), default="gzip", type=str)
+   a.add_argument("--float32", help="Store prices and percentages as float32 (halves the size of most matrices)", action="store_true")
+   a.add_argument("--incremental", help="Update existing matrices with days since their newest, rather than rebuild them", action="store_true")
    args = a.parse_args()
 
    pwd = str(args.dbpassword)
    if pwd.startswith('$'):
        pwd = os.getenv(args.dbpassword[1:])
-   mongo = pymongo.MongoClient(args.db, args.port, username=args.dbuser, password=pwd)
-   db = mongo[args.dbname]
+   mongo_args = { 'host': args.db, 'port': args.port, 'username': args.dbuser, 'password': pwd }
+   set_matrix_encoding(args.codec, args.float32)
 
-   load_all_prices(db, args.month, args.year, args.status)
+   if args.period:
+       db = pymongo.MongoClient(**mongo_args)[args.dbname]
+       stats = load_period_prices(db, args.period.upper(), args.year, args.status)
+   elif args.from_month:
+       months = months_between(args.from_month, args.to_month if args.to_month else args.from_month)
+       print("Building matrices for {} months with {} processes".format(len(months), args.workers))
+       stats = build_months(mongo_args, args.dbname, months, args.status, args.incremental, args.workers, args.max_cursors)
+   else:
+       assert args.month is not None # --month or --from is required
+       db = pymongo.MongoClient(**mongo_args)[args.dbname]
+       if args.incremental:
+           stats = refresh_prices(db, args.month, args.year, args.status)
+       else:
+           stats = load_all_prices(db, args.month, args.year, args.status)
+   print_summary(stats)
    print("Run completed successfully.")
    exit(0)
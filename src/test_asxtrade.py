@@ -0,0 +1,206 @@
+import pytest
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+import asxtrade
+from asxtrade import ColumnBuffer, BulkWriter, RunJournal, parse_asx_datetime, save_changes, read_prices_tsv, update_prices, run_worker, available_stocks, Metrics
+
+aest = timezone(timedelta(hours=10))
+
+def quote(asx_code, **kwargs):
+    d = { 'code': asx_code, 'isin_code': 'AU000000{}3'.format(asx_code), 'desc_full': 'Ordinary Fully Paid',
+          'last_price': 17.5, 'change_price': 0.12, 'change_in_percent': '0.691%', 'volume': 5123456,
+          'last_trade_date': parse_asx_datetime('2020-07-24T00:00:00+1000'), 'pe': 12.5, 'market_cap': 49612345678,
+          'suspended': False, 'fetch_date': '2020-07-24' }
+    d.update(kwargs)
+    return d
+
+def price_rows():
+    rows = ColumnBuffer()
+    rows.append(quote('ANZ'), 'ANZ')
+    rows.append({ 'error_code': 'id-or-code-invalid', 'error_desc': 'Invalid ASX code', 'fetch_date': '2020-07-24' }, 'ZZZ')
+    bhp = quote('BHP', last_price=38, volume=0, last_trade_date=parse_asx_datetime('2020-07-23T00:00:00+1000'))
+    del bhp['pe']
+    rows.append(bhp, 'BHP')
+    return rows
+
+# the prices.<date>.tsv which DataFrame.append() produced for price_rows(): ints stay ints if the first row had an int
+# (volume, market_cap), other numbers are floats (last_price of 38 is 38.0), missing keys are empty and datetimes
+# with a single UTC offset are written with it
+expected_tsv = "\n".join(["\t".join(row) for row in [
+    ['', 'code', 'isin_code', 'desc_full', 'last_price', 'change_price', 'change_in_percent', 'volume', 'last_trade_date',
+     'pe', 'market_cap', 'suspended', 'fetch_date', 'error_code', 'error_desc'],
+    ['ANZ', 'ANZ', 'AU000000ANZ3', 'Ordinary Fully Paid', '17.5', '0.12', '0.691%', '5123456', '2020-07-24 00:00:00+10:00',
+     '12.5', '49612345678', 'False', '2020-07-24', '', ''],
+    ['ZZZ', '', '', '', '', '', '', '', '', '', '', '', '2020-07-24', 'id-or-code-invalid', 'Invalid ASX code'],
+    ['BHP', 'BHP', 'AU000000BHP3', 'Ordinary Fully Paid', '38.0', '0.12', '0.691%', '0', '2020-07-23 00:00:00+10:00',
+     '', '49612345678', 'False', '2020-07-24', '', '']]]) + "\n"
+
+def test_column_buffer_tsv():
+    rows = price_rows()
+    assert len(rows) == 3
+    assert rows.to_dataframe().to_csv(sep='\t') == expected_tsv
+
+def test_column_buffer_dtypes():
+    rows = ColumnBuffer()
+    rows.append({ 'volume': 10, 'last_price': 1, 'eps': 0.5, 'last_trade_date': parse_asx_datetime('2020-10-02T00:00:00+1000') }, 'ANZ')
+    rows.append({ 'volume': 20, 'last_price': 2.5, 'eps': 1, 'last_trade_date': parse_asx_datetime('2020-10-05T00:00:00+1100') }, 'BHP')
+    df = rows.to_dataframe()
+    assert df['volume'].dtype == object and list(df['volume']) == [10, 20]
+    assert df['eps'].dtype == float
+    # NB: first row int wins, even though later rows are float
+    assert df['last_price'].dtype == object
+    # mixed AEST/AEDT offsets remain datetime objects
+    assert df['last_trade_date'].dtype == object
+
+def test_parse_asx_datetime():
+    assert parse_asx_datetime('2020-07-24T00:00:00+1000') == datetime(2020, 7, 24, tzinfo=aest)
+    assert parse_asx_datetime('2020-07-24T15:30:05+1100') == datetime(2020, 7, 24, 15, 30, 5, tzinfo=timezone(timedelta(hours=11)))
+    assert parse_asx_datetime('2020-07-24T00:00:00+1000').utcoffset() == timedelta(hours=10)
+    assert parse_asx_datetime('2020-07-24') == datetime(2020, 7, 24)
+    # anything else is parsed by dateutil, just as before
+    assert parse_asx_datetime('2020-07-24T00:00:00+10:00') == datetime(2020, 7, 24, tzinfo=aest)
+    assert parse_asx_datetime('24 Jul 2020') == datetime(2020, 7, 24)
+    with pytest.raises(ValueError):
+        parse_asx_datetime('not a date')
+
+def test_save_changes():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.companies
+    records = [{ 'asx_code': code, 'name': "{} LIMITED".format(code), 'sector': 'Banks' } for code in ['ANZ', 'CBA', 'NAB', 'WBC']]
+    assert save_changes(collection, records, ['asx_code'], ['name', 'sector']) == \
+           { 'inserted': 4, 'changed': 0, 'removed': 0, 'unchanged': 0 }
+    records[1] = dict(records[1], sector='Insurance')
+    assert save_changes(collection, records[0:3], ['asx_code'], ['name', 'sector'], max_removed_fraction=0.5) == \
+           { 'inserted': 0, 'changed': 1, 'removed': 1, 'unchanged': 2 }
+    assert collection.find_one({ 'asx_code': 'CBA' })['sector'] == 'Insurance'
+    assert collection.find_one({ 'asx_code': 'WBC' }) is None
+    # too many removals looks like a truncated download, so nothing is removed
+    assert save_changes(collection, records[0:1], ['asx_code'], ['name', 'sector']) == \
+           { 'inserted': 0, 'changed': 0, 'removed': 0, 'unchanged': 1 }
+    assert collection.count_documents({}) == 3
+
+def test_read_prices_tsv(tmp_path):
+    fname = tmp_path / "prices.2020-07-24.tsv"
+    price_rows().to_dataframe().to_csv(fname, sep='\t')
+    docs = { d['asx_code']: d for d in read_prices_tsv(fname) }
+    assert list(docs.keys()) == ['ANZ', 'ZZZ', 'BHP']
+    anz = docs['ANZ']
+    assert anz['volume'] == 5123456 and isinstance(anz['volume'], int)
+    assert anz['market_cap'] == 49612345678 and isinstance(anz['market_cap'], int)
+    assert anz['last_price'] == 17.5 and anz['pe'] == 12.5
+    assert anz['last_trade_date'] == datetime(2020, 7, 24, tzinfo=aest)
+    assert anz['suspended'] is False
+    assert anz['change_in_percent'] == '0.691%' and anz['fetch_date'] == '2020-07-24'
+    assert not 'error_code' in anz
+    assert docs['ZZZ'] == { 'asx_code': 'ZZZ', 'fetch_date': '2020-07-24', 'error_code': 'id-or-code-invalid', 'error_desc': 'Invalid ASX code' }
+    assert not 'pe' in docs['BHP'] and docs['BHP']['volume'] == 0 and docs['BHP']['last_price'] == 38.0
+
+def test_bulk_writer_on_write():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.asx_prices
+    calls = []
+    writer = BulkWriter(collection, batch_size=2, on_write=lambda keys, error: calls.append((keys, error is None)))
+    writer.add(InsertOne({ '_id': 'ANZ' }), key='ANZ')
+    assert calls == [] # nothing is reported until its batch has been written
+    writer.add(InsertOne({ '_id': 'BHP' }), key='BHP')
+    assert calls == [(['ANZ', 'BHP'], True)]
+    # a write error fails only the ops it names: the rest of the (unordered) batch was saved
+    writer.add(InsertOne({ '_id': 'CBA' }), key='CBA')
+    with pytest.raises(BulkWriteError):
+        writer.add(InsertOne({ '_id': 'ANZ' }), key='ANZ')
+    assert calls[1:] == [(['CBA'], True), (['ANZ'], False)]
+    assert writer.n_written == 3
+    assert collection.count_documents({}) == 3
+
+class FakeResponse:
+    def __init__(self, asx_code):
+        self.status_code = 200
+        self.content = json.dumps({ 'code': asx_code, 'last_price': 1.5, 'volume': 100, 'change_in_percent': '1.2%',
+                                    'last_trade_date': '2020-07-24T00:00:00+1000' }).encode()
+
+class FakeFetcher:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def get(self, url, timeout=None):
+        asx_code = url.rsplit('/', 1)[1]
+        if asx_code in self.failing:
+            raise IOError("unable to fetch {}".format(asx_code))
+        return FakeResponse(asx_code)
+
+def test_update_prices_resume(tmp_path, monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    (tmp_path / 'asx_prices').mkdir()
+    config = { 'asx_prices': 'http://localhost/asx/1/share/', 'data_root': str(tmp_path), 'requests_per_second': 1000,
+               'archive_raw_responses': 0 }
+    stocks = ['C{:02d}'.format(i) for i in range(40)]
+    monkeypatch.setattr(asxtrade, 'thread_fetcher', lambda: FakeFetcher(failing=stocks[30:]))
+    update_prices(db, stocks, config, '2020-07-24')
+    journal = RunJournal.resume(db, 'prices', '2020-07-24')
+    assert sorted(journal.pending_stocks()) == stocks[30:]
+    monkeypatch.setattr(asxtrade, 'thread_fetcher', lambda: FakeFetcher())
+    update_prices(db, journal.pending_stocks(), config, '2020-07-24', journal=journal)
+    assert db.asx_prices.count_documents({ 'fetch_date': '2020-07-24' }) == 40
+    # the TSV and validation report are for the whole day, not just the stocks fetched by the resumed run
+    df = pd.read_csv(tmp_path / 'asx_prices' / 'prices.2020-07-24.tsv', sep='\t', index_col=0)
+    assert sorted(df.index) == stocks
+    assert db.price_validation.find_one({ 'fetch_date': '2020-07-24' })['n_stocks'] == 40
+
+def test_run_worker_finishes_once(tmp_path, monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    (tmp_path / 'asx_prices').mkdir()
+    config = { 'asx_prices': 'http://localhost/asx/1/share/', 'data_root': str(tmp_path), 'requests_per_second': 1000,
+               'archive_raw_responses': 0, 'work_batch_size': 5, 'fetch_workers': 2, 'lease_seconds': 1 }
+    stocks = ['C{:02d}'.format(i) for i in range(20)]
+    monkeypatch.setattr(asxtrade, 'thread_fetcher', lambda: FakeFetcher())
+    # worst case of the race between completing a batch and counting those remaining: every worker sees none remain
+    complete = asxtrade.WorkQueue.complete
+    monkeypatch.setattr(asxtrade.WorkQueue, 'complete', lambda self, batch, retry=None: complete(self, batch, retry=retry) * 0)
+    finished = []
+    workers = [threading.Thread(target=lambda worker_id: finished.append(run_worker(db, config, 'prices', '2020-07-24', stocks, worker_id=worker_id)),
+                                args=('worker{}'.format(i),)) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sorted(finished) == [False, True]
+    assert db.ingest_runs.find_one({ 'run_id': 'prices-2020-07-24-sharded' })['status'] == 'completed'
+    assert db.asx_prices.count_documents({ 'fetch_date': '2020-07-24' }) == 20
+
+def test_available_stocks_zero_volume(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    db.asx_isin.insert_many([{ 'asx_code': asx_code, 'security_name': 'ORDINARY FULLY PAID' } for asx_code in ['ANZ', 'DEAD']])
+    expired = datetime(2020, 7, 23)
+    db.asx_zero_volume.insert_one({ 'asx_code': 'DEAD', 'reason': 'zero volume', 'valid_until': expired })
+    monkeypatch.setattr(asxtrade, 'zero_volume_stocks', lambda db, config: set(['DEAD']))
+    config = { 'exclude_zero_volume_stocks': 1 }
+    # a details run must not use up the price probe of a dormant stock whose skip has expired
+    assert available_stocks(db, config, for_prices=False) == ['ANZ', 'DEAD']
+    assert db.asx_zero_volume.find_one({ 'asx_code': 'DEAD' })['valid_until'] == expired
+    assert available_stocks(db, config) == ['ANZ', 'DEAD']
+    assert db.asx_zero_volume.find_one({ 'asx_code': 'DEAD' })['valid_until'] > datetime.utcnow()
+    assert available_stocks(db, config) == ['ANZ']
+
+def test_metrics_summary_keys():
+    m = Metrics()
+    m.observe_mongo('insert', 'market_quote_cache.chunks', 0.02)
+    m.observe_mongo('find', 'market_quote_cache.files', 0.01, failed=True)
+    m.observe_mongo('ping', '', 0.001)
+    summary = m.summary()
+    assert summary['mongo']['market_quote_cache_chunks']['insert'] == { 'ops': 1, 'seconds': 0.02, 'failures': 0 }
+    assert summary['mongo']['market_quote_cache_files']['find']['failures'] == 1
+    assert 'none' in summary['mongo']
+    # the summary is saved to ingest_metrics, so no key may contain a dot
+    def keys(d):
+        for k, v in d.items():
+            yield k
+            if isinstance(v, dict):
+                yield from keys(v)
+    assert not any(['.' in str(k) for k in keys(summary)])
@@ -1,4 +1,4 @@
-from app.models import Quotation, CompanyDetails, all_sector_stocks, company_prices, day_low_high
+from app.models import Quotation, CompanyDetails, all_sector_stocks, company_prices, day_low_high, parse_fetch_date
 from app.plots import *
 from app.messages import warning
 from datetime import datetime, timedelta
@@ -265,7 +265,7 @@ def analyse_sector(stock, sector, all_stocks_cip, window_size=14):
        stock_versus_sector = []
        # identify the best performing stock in the sector and add it to the stock_versus_sector rows...
        best_stock_in_sector = cip.sum(axis=1).nlargest(1).index[0]
-       for day in sorted(cip.columns, key=lambda k: datetime.strptime(k, "%Y-%m-%d")):
+       for day in sorted(cip.columns, key=parse_fetch_date):
            for asx_code, daily_change in cip[day].iteritems():
                cum_sum[asx_code] += daily_change
            n_pos = len(list(filter(lambda t: t[1] >= 5.0, cum_sum.items())))
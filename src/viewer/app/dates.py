@@ -0,0 +1,12 @@
+from datetime import datetime
+
+def parse_fetch_date(d):
+    """
+    Convert a fetch_date string (YYYY-mm-dd) to a datetime with datetime.fromisoformat(), which is many times faster than
+    datetime.strptime(): this matters when used as a sort key over hundreds of dates. Kept free of django so that
+    bench_dates.py can time it. Anything not in that format (eg. 2020-2-2) is handed to strptime() so that such
+    dates are parsed, or fail, just as they always have.
+    """
+    if len(d) == 10 and d[4] == '-' and d[7] == '-':
+        return datetime.fromisoformat(d)
+    return datetime.strptime(d, "%Y-%m-%d")
@@ -1,15 +1,24 @@
 import django.db.models as model
 from django.conf import settings
 from django.forms.models import model_to_dict
-from djongo.models import ObjectIdField, DjongoManager
+from djongo.models import ObjectIdField, GenericObjectIdField, DjongoManager
 from djongo.models.json import JSONField
 from app.messages import warning
+from app.dates import parse_fetch_date
 import pylru
 from collections import defaultdict
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
 import re
 import io
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pymongo
+import gridfs
 
 def validate_stock(stock):
     assert stock is not None
@@ -214,7 +223,7 @@ def all_available_dates(reference_stock='ANZ'):
 
     # use reference_stock to quickly search the db by limiting the stocks searched
     dates = Quotation.objects.mongo_distinct('fetch_date', { 'asx_code': reference_stock })
-    ret = sorted(dates, key=lambda k: datetime.strptime(k, "%Y-%m-%d"))
+    ret = sorted(dates, key=parse_fetch_date)
     date_cache[reference_stock] = ret
     return ret
 
@@ -266,7 +275,7 @@ def desired_dates(today=None, start_date=None): # today is provided as keyword a
     if isinstance(start_date, (datetime, date)):
         pass # FALLTHRU
     elif isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
+        start_date = parse_fetch_date(start_date)
     elif isinstance(start_date, int):
         assert start_date > 0
         start_date = today - timedelta(days=start_date - 1) # -1 for today inclusive
@@ -275,7 +284,7 @@ def desired_dates(today=None, start_date=None): # today is provided as keyword a
     assert start_date <= today
     all_dates = [d.strftime("%Y-%m-%d") for d in pd.date_range(start_date, today, freq='D')]
     assert len(all_dates) > 0
-    return sorted(all_dates, key=lambda d: datetime.strptime(d, "%Y-%m-%d"))
+    return sorted(all_dates, key=parse_fetch_date)
 
 def find_named_companies(wanted_name, wanted_activity):
     ret = set()
@@ -330,30 +339,206 @@ def latest_quote(stocks):
                 qs = qs.filter(asx_code__in=stocks)
         return (qs, latest_date)
 
-def make_superdf(required_tags, stock_codes):
+market_data_bucket = None
+
+def matrix_fp(parquet_bytes, gridfs_id):
+    """
+    Return a file object for a market_quote_cache matrix, which is either inline (parquet_bytes) or in GridFS for
+    matrices too big for a mongo document (see persist_dataframes.save_blob()). GridFS files are streamed, so
+    pyarrow downloads only the footer and the columns it reads. djongo can't do GridFS so we use pymongo directly.
+    """
+    global market_data_bucket
+    if gridfs_id is None:
+        return io.BytesIO(parquet_bytes)
+    if market_data_bucket is None:
+        db_settings = settings.DATABASES['default']
+        db = pymongo.MongoClient(**db_settings.get('CLIENT'))[db_settings.get('NAME')]
+        market_data_bucket = gridfs.GridFSBucket(db, bucket_name='market_quote_cache')
+    return market_data_bucket.open_download_stream(gridfs_id)
+
+def plan_tags(field, all_dates):
+    """
+    Return the tags of the matrices to read for field over all_dates: for each month, a FINAL yearly or quarterly
+    matrix (see persist_dataframes.load_period_prices()) covering it in preference to the monthly matrix, so that long
+    date ranges need a few large matrices rather than a dozen or more monthly ones. Costs one query for the tags.
+    """
+    months = sorted(set([(date[0:4], date[5:7]) for date in all_dates]))
+    def candidates(yyyy, mm):
+        return ["{}-YR-{}-asx".format(field, yyyy), "{}-Q{}-{}-asx".format(field, (int(mm) - 1) // 3 + 1, yyyy),
+                "{}-{}-{}-asx".format(field, mm, yyyy)]
+    period_tags = set([tag for yyyy, mm in months for tag in candidates(yyyy, mm)[0:2]])
+    available = set(MarketDataCache.objects.filter(tag__in=period_tags, status="FINAL", dataframe_format="parquet") \
+                                           .values_list('tag', flat=True))
+    required_tags = set()
+    for yyyy, mm in months:
+        tags = candidates(yyyy, mm)
+        required_tags.add(next((tag for tag in tags[0:2] if tag in available), tags[-1]))
+    return required_tags
+
+def widen_dtypes(df):
+    """
+    Matrices may be saved with float32 values to save space (persist_dataframes.py --float32): widen them to float64
+    so that callers see the same dtypes however each matrix was saved
+    """
+    float32_cols = [col for col, dtype in df.dtypes.items() if dtype == 'float32']
+    if len(float32_cols) == 0:
+        return df
+    return df.astype({ col: 'float64' for col in float32_cols })
+
+def mirror_table(tag, sha256):
+    """
+    Return the matrix for tag as a memory-mapped arrow table from the local mirror (settings.MARKET_DATA_MIRROR,
+    maintained by mirror_matrices.py) or None if the mirror doesn't have this version (sha256) of it. Mapped pages
+    are shared by all processes on the host and pandas uses them without copying.
+    """
+    mirror_dir = getattr(settings, 'MARKET_DATA_MIRROR', None)
+    if mirror_dir is None or sha256 is None:
+        return None
+    try:
+        source = pa.memory_map(os.path.join(mirror_dir, "{}.{}.arrow".format(tag, sha256)), 'r')
+    except OSError: # not mirrored (yet)
+        return None
+    return pa.ipc.open_file(source).read_all()
+
+def select_columns(names, index_columns, columns):
+    if columns is None:
+        return None
+    columns = set(columns)
+    return [c for c in names if c in columns or c in index_columns]
+
+def stock_row_groups(pf, stock_codes):
+    """
+    Return the row groups of the parquet file pf which may hold any of stock_codes, judging by the min/max statistics
+    of the asx_code index (matrices are saved sorted by asx_code, see persist_dataframes.matrix_row_group_size) or
+    None if all row groups must be read
+    """
+    if stock_codes is None or (pf.schema_arrow.pandas_metadata or {}).get('index_columns') != ['asx_code']:
+        return None
+    i = pf.schema_arrow.get_field_index('asx_code')
+    codes = sorted(stock_codes)
+    row_groups = []
+    for rg in range(pf.metadata.num_row_groups):
+        stats = pf.metadata.row_group(rg).column(i).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        j = bisect_left(codes, stats.min)
+        if j < len(codes) and codes[j] <= stats.max:
+            row_groups.append(rg)
+    return row_groups
+
+decode_pool = None # threads decoding parquet matrices, see matrix_frames()
+
+def decode_matrix(parquet_bytes, gridfs_id, columns, stock_codes):
+    with matrix_fp(parquet_bytes, gridfs_id) as fp:
+        pf = pq.ParquetFile(fp)
+        wanted = select_columns(pf.schema_arrow.names, [], columns)
+        row_groups = stock_row_groups(pf, stock_codes)
+        if row_groups is None:
+            table = pf.read(columns=wanted, use_pandas_metadata=True)
+        else:
+            table = pf.read_row_groups(row_groups, columns=wanted, use_pandas_metadata=True)
+        return widen_dtypes(table.to_pandas())
+
+def matrix_frames(required_tags, dataframe_format, columns=None, stock_codes=None):
+    """
+    Return a list with the dataframe for each of the required_tags (of the given dataframe_format) which exists,
+    reading only the specified columns (plus the index) if given. If stock_codes is given, rows for other stocks may
+    be omitted: only the parts of each matrix which may contain the stock_codes are decoded. Matrices come from the
+    local mirror when it is current, and otherwise from mongo with one query for all of them: these are decoded in
+    parallel (pyarrow releases the GIL) using settings.MATRIX_DECODE_THREADS threads.
+    """
+    global decode_pool
+    tags = set(required_tags)
+    ret = []
+    if getattr(settings, 'MARKET_DATA_MIRROR', None) is not None:
+        versions = MarketDataCache.objects.filter(tag__in=tags, dataframe_format=dataframe_format).values_list('tag', 'sha256')
+        for tag, sha256 in versions:
+            table = mirror_table(tag, sha256)
+            if table is None:
+                continue
+            tags.remove(tag)
+            index_columns = [c for c in table.schema.pandas_metadata.get('index_columns', []) if isinstance(c, str)]
+            wanted = select_columns(table.schema.names, index_columns, columns)
+            if wanted is not None:
+                table = table.select(wanted)
+            if stock_codes is not None and index_columns == ['asx_code']:
+                table = table.filter(pc.is_in(table.column('asx_code'), value_set=pa.array(list(stock_codes), pa.string())))
+            ret.append(widen_dtypes(table.to_pandas(split_blocks=True)))
+        if len(tags) == 0:
+            return ret
+    dataframes = list(MarketDataCache.objects.filter(tag__in=tags, dataframe_format=dataframe_format) \
+                                             .values_list('dataframe', 'gridfs_id'))
+    if len(dataframes) <= 1:
+        return ret + [decode_matrix(parquet_bytes, gridfs_id, columns, stock_codes) for parquet_bytes, gridfs_id in dataframes]
+    if decode_pool is None:
+        decode_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'MATRIX_DECODE_THREADS', 4))
+    return ret + list(decode_pool.map(lambda rec: decode_matrix(rec[0], rec[1], columns, stock_codes), dataframes))
+
+def plan_superdf(field, all_dates):
+    """
+    Return (required_tags, columns): the fewest matrices to read for field over all_dates (see plan_tags()) and the
+    dates to read from them in ascending order. Dates are strictly YYYY-mm-dd (see validate_date()) so sorting them
+    as strings is chronological: no need to parse them.
+    """
+    return (plan_tags(field, all_dates), sorted(set(all_dates)))
+
+def concat_matrices(dataframes, stock_codes):
+    """
+    Join stocks X dates matrices for disjoint dates into one dataframe with a single concat, rather than merging them
+    one at a time (which copies the growing result each time). Stocks are rows (the stock_codes if given, otherwise
+    every stock in any matrix in asx_code order) and dates are columns in ascending order. Returns None if there are no
+    matrices.
+    """
+    if len(dataframes) == 0:
+        return None
+    dataframes = sorted(dataframes, key=lambda df: min(df.columns, default=''))
+    if stock_codes is not None:
+        dataframes = [df.reindex(tuple(stock_codes)) for df in dataframes] # remove rows which are not relevant
+    superdf = pd.concat(dataframes, axis=1, sort=False)
+    if stock_codes is None:
+        superdf = superdf.sort_index()
+    if not superdf.columns.is_monotonic_increasing:
+        superdf = superdf[sorted(superdf.columns)]
+    return superdf
+
+def make_superdf(required_tags, stock_codes, columns=None):
+    """
+    Return (superdf, n_dataframes) with the matrices for the required_tags joined into one stocks X dates dataframe
+    (see concat_matrices()), rows for stock_codes only if given. Only the columns (dates) specified are decoded, if given.
+    """
     assert required_tags is not None and len(required_tags) >= 1
     assert stock_codes is None or len(stock_codes) > 0 # NB: zero stocks considered bad
-    dataframes = MarketDataCache.objects.filter(tag__in=required_tags, dataframe_format="parquet") \
-                                        .values_list('dataframe', flat=True)
-    superdf = None
-    n = 0
-    for parquet_bytes in dataframes:
-        n += 1
-        with io.BytesIO(parquet_bytes) as fp:
-            df = pd.read_parquet(fp)
-            if len(df) == 0:  # skip empty frames: not that persist_dataframes.py has a bug where the matrix has wrong/index columns when empty so be careful not to merge them!
-                continue
-            # remove rows which are not relevant before merge to speed things...
-            if stock_codes is not None:
-                #print("Before {}".format(len(df)))
-                df = df.reindex(tuple(stock_codes))
-                #print("After {} (had {} stocks)".format(len(df), len(stock_codes)))
-            #print(df)
-            if superdf is None:
-                superdf = df
-            else:
-                superdf = superdf.merge(df, how='outer', left_index=True, right_index=True)
-    return (superdf, n)
+    dataframes = matrix_frames(required_tags, "parquet", columns=columns, stock_codes=stock_codes)
+    # skip empty frames: not that persist_dataframes.py has a bug where the matrix has wrong/index columns when empty so be careful not to merge them!
+    superdf = concat_matrices([df for df in dataframes if len(df) > 0 or df.index.name == 'asx_code'], stock_codes)
+    return (superdf, len(dataframes))
+
+def split_wide(df, fields):
+    """
+    Split a wide matrix (stocks X "field:date" columns) into a dict of field -> matrix (stocks X dates) for each of fields
+    """
+    ret = {}
+    for field in fields:
+        prefix = field + ':'
+        cols = [c for c in df.columns if c.startswith(prefix)]
+        ret[field] = df[cols].rename(columns=lambda c: c[len(prefix):])
+        ret[field].columns.name = 'fetch_date'
+    return ret
+
+def wide_superdfs(fields, all_dates, stock_codes):
+    """
+    As for make_superdf() but for several fields at once: returns a dict of field -> (superdf, n_dataframes) over
+    all_dates using the wide monthly matrices saved by persist_dataframes.py, reading only the needed columns
+    of each. Returns None if any month has no wide matrix, in which case callers should use make_superdf() per field.
+    """
+    assert len(fields) >= 1
+    required_tags = set(["all-{}-{}-asx".format(date[5:7], date[0:4]) for date in all_dates])
+    wanted = set(["{}:{}".format(field, date) for field in fields for date in all_dates])
+    dataframes = list(matrix_frames(required_tags, "parquet-wide", columns=wanted, stock_codes=stock_codes))
+    if len(dataframes) < len(required_tags):
+        return None
+    split = [split_wide(df, fields) for df in dataframes]
+    return { field: (concat_matrices([matrices[field] for matrices in split], stock_codes), len(dataframes)) for field in fields }
 
 def day_low_high(stock, all_dates=None):
     """
@@ -395,9 +580,9 @@ def all_etfs():
 
 def increasing_eps(stock_codes, past_n_days=300):
     all_dates = desired_dates(start_date=past_n_days)
-    required_tags = set(["eps-{}-{}-asx".format(date[5:7], date[0:4]) for date in all_dates])
+    required_tags, dates = plan_superdf("eps", all_dates)
     # NB: we dont care here if some tags cant be found
-    df, n = make_superdf(required_tags, stock_codes)
+    df, n = make_superdf(required_tags, stock_codes, columns=dates)
     # df will be very large: 300 days * ~2000 stocks... but mostly the numbers will be the same each day...
     # at least 2c per share positive max(eps) is required to be considered significant
     increasing_eps_stocks = [idx for idx, series in df.iterrows() if series.is_monotonic_increasing and max(series) >= 0.02]
@@ -405,22 +590,29 @@ def increasing_eps(stock_codes, past_n_days=300):
 
 def increasing_yield(stock_codes, past_n_days=300):
     all_dates = desired_dates(start_date=past_n_days)
-    required_tags = set(["annual_dividend_yield-{}-{}-asx".format(date[5:7], date[0:4]) for date in all_dates])
-    df, n = make_superdf(required_tags, stock_codes)
+    required_tags, dates = plan_superdf("annual_dividend_yield", all_dates)
+    df, n = make_superdf(required_tags, stock_codes, columns=dates)
     # ignore penny-ante stocks (must be at least 1c per share dividend)
     increasing_yield_stocks = [idx for idx, series in df.iterrows() if series.is_monotonic_increasing and max(series) >= 0.01]
     return increasing_yield_stocks
 
-def company_prices(stock_codes, all_dates=None, fields='last_price', fail_missing_months=True, fix_missing=True):
+def company_prices(stock_codes, all_dates=None, fields='last_price', fail_missing_months=True, fix_missing=True, prefetched=None):
     """
     Return a dataframe with the required companies (iff quoted) over the
     specified dates. By default last_price is provided. Fields may be a list,
-    in which case the dataframe has columns for each field and dates are rows (in this case only one stock is permitted)
+    in which case the dataframe has columns for each field and dates are rows (in this case only one stock is permitted).
+    Multiple fields are fetched from the wide matrices when available (see wide_superdfs()), rather than one matrix per field.
     """
+    if all_dates is None:
+        all_dates = [ datetime.strftime(datetime.now(), "%Y-%m-%d") ]
     if not isinstance(fields, str): # assume iterable if not str...
         assert len(stock_codes) == 1
+        superdfs = wide_superdfs(fields, all_dates, stock_codes)
+        if superdfs is None:
+            superdfs = {}
         dataframes = [company_prices(stock_codes, all_dates=all_dates,
-                                         fields=field, fail_missing_months=fail_missing_months) for field in fields]
+                                         fields=field, fail_missing_months=fail_missing_months,
+                                         prefetched=superdfs.get(field)) for field in fields]
         result_df = pd.concat(dataframes, ignore_index=True)
         result_df.set_index(pd.Index(fields), inplace=True)
         #print(result_df)
@@ -434,29 +626,21 @@ def company_prices(stock_codes, all_dates=None, fields='last_price', fail_missin
 
     #print(stock_codes)
     assert isinstance(fields, str)
-    if all_dates is None:
-        all_dates = [ datetime.strftime(datetime.now(), "%Y-%m-%d") ]
 
-    required_tags = set()
     for date in all_dates:
         validate_date(date)
-        yyyy = date[0:4]
-        mm = date[5:7]
-        required_tags.add("{}-{}-{}-asx".format(fields, mm, yyyy))
-    which_cols = set(all_dates)
-    # construct a "super" dataframe from the constituent parquet data
-    superdf, n_dataframes = make_superdf(required_tags, stock_codes)
-
-    # drop columns not present in all_dates to ensure we are giving just the results requested
-    cols_to_drop = [date for date in superdf.columns if date not in which_cols]
-    superdf = superdf.drop(columns=cols_to_drop)
+    # construct a "super" dataframe from the constituent parquet data (unless the caller already has it). Either way
+    # it has just the dates requested, ALWAYS in ascending date order
+    if prefetched is None:
+        required_tags, dates = plan_superdf(fields, all_dates)
+        superdf, n_dataframes = make_superdf(required_tags, stock_codes, columns=dates)
+    else:
+        required_tags = set(["all-{}-{}-asx".format(date[5:7], date[0:4]) for date in all_dates])
+        superdf, n_dataframes = prefetched
 
     # on the first of the month, we dont have data yet so we permit one missing tag for this reason
     if fail_missing_months and n_dataframes < len(required_tags) - 1:
         raise ValueError("Not all required data is available - aborting! Found {} wanted {}".format(n_dataframes, required_tags))
-    # NB: ensure all columns are ALWAYS in ascending date order
-    dates = sorted(list(superdf.columns), key=lambda k: datetime.strptime(k, "%Y-%m-%d"))
-    superdf = superdf[dates]
     if fix_missing and superdf.isnull().values.any():
         warning(None, "Missing data found in fields={} stocks={} over dates: {}-{}".format(fields, stock_codes, all_dates[0], all_dates[-1]))
         superdf = impute_missing(superdf)
@@ -481,7 +665,8 @@ class MarketDataCache(model.Model):
     sha256 = model.TextField()
     _id = ObjectIdField()
     scope = model.TextField()
-    dataframe = model.BinaryField()
+    dataframe = model.BinaryField(null=True)
+    gridfs_id = GenericObjectIdField(null=True) # set instead of dataframe for matrices stored in GridFS
 
     class Meta:
         managed = False # table is managed by persist_dataframes.py
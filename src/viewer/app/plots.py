@@ -3,7 +3,7 @@ import matplotlib.pyplot as plt
 import matplotlib.font_manager as font_manager
 import plotnine as p9
 from app.analysis import *
-from app.models import stocks_by_sector, desired_dates
+from app.models import stocks_by_sector, desired_dates, parse_fetch_date
 import numpy as np
 import pandas as pd
 import base64
@@ -47,7 +47,7 @@ def make_sentiment_plot(sentiment_df, exclude_zero_bin=True, plot_text_labels=Tr
             bin = str(bin)
             assert isinstance(bin, str)
             val = int(val)
-            rows.append({ 'date': datetime.strptime(date, "%Y-%m-%d"), 'bin': bin, 'value': val })
+            rows.append({ 'date': parse_fetch_date(date), 'bin': bin, 'value': val })
 
     df = pd.DataFrame.from_records(rows)
     #print(df['bin'].unique())
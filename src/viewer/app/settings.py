@@ -143,3 +143,9 @@ INTERNAL_IPS = [ '127.0.0.1', ]
 
 STATIC_URL = '/static/'
 STATIC_ROOT = '/home/acas/src/asxtrade/src/viewer/static'
+
+# Local directory of memory-mapped matrices maintained by mirror_matrices.py (None to always read matrices from mongo)
+MARKET_DATA_MIRROR = os.getenv('MARKET_DATA_MIRROR', None)
+
+# Number of threads per process decoding the matrices needed by a request (see app.models.matrix_frames())
+MATRIX_DECODE_THREADS = 4
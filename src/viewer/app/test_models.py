@@ -1,5 +1,7 @@
 import pytest
-from app.models import validate_stock, validate_date, desired_dates
+from datetime import datetime
+import pandas as pd
+from app.models import validate_stock, validate_date, desired_dates, parse_fetch_date, split_wide, concat_matrices
 
 def test_validate_stock():
     validate_stock('ANZ') # NB: must not assert
@@ -21,3 +23,32 @@ def test_desired_dates():
     ret = desired_dates(7, today=now)
     assert ret == ['2020-08-17', '2020-08-18', '2020-08-19',
                    '2020-08-20', '2020-08-21', '2020-08-22', '2020-08-23']
+
+def test_parse_fetch_date():
+    assert parse_fetch_date('2020-08-23') == datetime(2020, 8, 23)
+    assert parse_fetch_date('2020-12-01') == datetime(2020, 12, 1)
+    # dates which are not strict YYYY-mm-dd must behave just as strptime() does
+    with pytest.raises(ValueError):
+        parse_fetch_date('2020-02-30')
+    assert parse_fetch_date('2020-2-2') == datetime.strptime('2020-2-2', '%Y-%m-%d')
+
+def test_split_wide():
+    df = pd.DataFrame({ 'last_price:2020-08-21': [1.0, 2.0], 'last_price:2020-08-24': [1.5, 2.5],
+                        'volume:2020-08-21': [100.0, 200.0] }, index=pd.Index(['ANZ', 'BHP'], name='asx_code'))
+    ret = split_wide(df, ['last_price', 'volume', 'eps'])
+    assert list(ret['last_price'].columns) == ['2020-08-21', '2020-08-24']
+    assert list(ret['last_price'].loc['BHP']) == [2.0, 2.5]
+    assert list(ret['volume'].columns) == ['2020-08-21']
+    assert len(ret['eps'].columns) == 0 and list(ret['eps'].index) == ['ANZ', 'BHP']
+
+def test_concat_matrices():
+    aug = pd.DataFrame({ '2020-08-28': [1.0, 2.0], '2020-08-31': [1.5, 2.5] }, index=pd.Index(['BHP', 'ANZ'], name='asx_code'))
+    sep = pd.DataFrame({ '2020-09-01': [3.0] }, index=pd.Index(['CBA'], name='asx_code'))
+    df = concat_matrices([sep, aug], None)
+    assert list(df.columns) == ['2020-08-28', '2020-08-31', '2020-09-01']
+    assert list(df.index) == ['ANZ', 'BHP', 'CBA']
+    assert list(df.loc['ANZ'].fillna(-1.0)) == [2.0, 2.5, -1.0]
+    df = concat_matrices([sep, aug], ['CBA', 'ANZ'])
+    assert list(df.index) == ['CBA', 'ANZ']
+    assert df.loc['CBA', '2020-09-01'] == 3.0
+    assert concat_matrices([], None) is None
@@ -411,7 +411,7 @@ def show_purchase_performance(request):
     portfolio_cost = 0.0
 
     for d in all_dates:
-        d = datetime.strptime(d, "%Y-%m-%d").date()
+        d = parse_fetch_date(d).date()
         d_str = str(d)
         if d_str not in df.columns: # not a trading day?
             continue